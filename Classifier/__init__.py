@@ -16,11 +16,29 @@
 ##                 implements class "hmm_classifier" which classifies
 ##                 using a naive HMM algorithm.
 ##
+## snapshot     -- frozen in-memory copy of a database, for fast read-only
+##                 classification without SQL.  provides "model_snapshot"
+##                 and "snapshot_classifier".
+##
 ## mailwrangler -- utilities for extracting text from e-mail, etc.
 ##                 notable:  split_text(), split_html(), split_mail()
 ##
+## mailserver   -- long-running server that tags e-mail sent to it over a
+##                 Unix-domain socket.  provides "tag_server".
+##
+## changelog    -- replication of training data by logs of the changes
+##                 written to a database.  notable:  replay_log()
+##
+## workpool     -- classification and training by a pool of threads,
+##                 which return results to be waited for or handled by
+##                 callbacks.  provides "classifier_pool".
+##
 ## textparsers  -- composeable text manipulation functions.
 ##
+## stats        -- optional instrumentation:  SQL statement counts, cache
+##                 hit rates and per-stage timings.  see stats.enable()
+##                 and stats.report().
+##
 ## -- Basic usage:
 ##
 ## c = hmm_classifier("/path/to/database")
@@ -40,8 +58,12 @@
 __version__ = '1.2'
 
 from classifier import *
+from snapshot import *
+from changelog import *
+from workpool import *
 from mailwrangler import *
+from mailserver import *
 from textparsers import word_split, aggregator
-import textparsers
+import stats, textparsers
 
 # Here there be dragons
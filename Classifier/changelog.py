@@ -0,0 +1,148 @@
+##
+## Name:     changelog.py
+## Purpose:  Replicate training data by logs of the changes made to it.
+##
+## Copyright (C) 2008 Michael J. Fromberger, All Rights Reserved.
+##
+## A database opened with a change_log (see classdata.groupdata) appends
+## one line to the log for each transaction that changes it:  a commit,
+## the creation of a group, or a compaction.  Each line is a JSON array
+## [seq, record], where seq is a sequence number kept in the database,
+## one more than that of the line before, and record is an object with
+## these keys, each present only if needed:
+##
+##   hash     -- word hashing mode of the database (always present).
+##   settings -- list of [name, op, value] changes to settings, in order;
+##               op is "add" to add an integer, or "set".
+##   groups   -- list of names of groups created.
+##   docs     -- object mapping group names to [op, value] changes to
+##               their document counts.
+##   set      -- object mapping group names to lists of [word, count]
+##               pairs, giving new counts of words in the group.
+##   add      -- as "set", but giving amounts to add to the counts.
+##   compact  -- the limits given to groupdata.compact().
+##
+## Words are as stored:  if the database hashes words, they are the hash
+## keys.  Counts are limited below by zero as they are changed.
+##
+## The log can be replayed by replay_log() into a copy of the database
+## taken at any time, or into a snapshot exported from one, so that the
+## copy follows the original by applying only what has changed.  Each
+## copy records the sequence number of the last line it has applied, so
+## a log can be replayed again as it grows; it is an error for lines to
+## be missing.  For this to work, every program that changes the
+## original database must log its changes to the same log.
+##
+## A line is written to the log, and flushed to disk, before the
+## transaction it records is committed, so the log is never behind the
+## database.  If the writer fails between the two, the log holds a line
+## the database does not include; the next writer to open the database
+## with the same log path removes it (see trim_log()) before it logs
+## anything, so the log never holds two lines with the same number.  A
+## copy replayed in the moment between the two may already have applied
+## such a line, and should be replaced.
+##
+## Recovery:  if a log is missing lines a copy needs (for instance, if
+## the log was lost or truncated, or the database was changed by a
+## program that did not log its changes), replay_log() raises
+## ValueError naming the missing lines, and the copy cannot be brought
+## up to date from that log.  Replace the copy with a new copy of the
+## database, or a new snapshot exported from it, and replay the log
+## into that; lines already included are skipped.
+##
+
+import itertools, json
+
+# Number of change records applied together by replay_log()
+replay_batch_size = 1000
+
+
+def read_log(fp):
+    """Generate the (sequence number, change record) pairs in the change
+    log read from the file fp, in order.  A last line with no newline
+    is taken to be still being written, and is ignored.
+    """
+    for line in fp:
+        if not line.endswith('\n'):
+            break
+        seq, rec = json.loads(line)
+        yield seq, rec
+
+
+def replay_log(fp, target, batch_size=replay_batch_size):
+    """Apply the change records read from fp that target does not yet
+    include.  The target may be a classdata.groupdata or a
+    snapshot.model_snapshot; see their .apply_changes() methods.  The
+    records are applied batch_size at a time, each batch in a single
+    transaction.  Returns the number of records applied.
+    """
+    last = target.log_sequence()
+
+    # Records already applied are skipped without decoding them.
+    lines = itertools.dropwhile(
+        lambda line: (line.endswith('\n') and
+                      int(line[1:line.index(',')]) <= last), fp)
+
+    batch = []
+    num = 0
+    for elt in read_log(lines):
+        if elt[0] > last + 1:
+            raise ValueError("Change log is missing records %d to %d; "
+                             "replace the copy with a new one" %
+                             (last + 1, elt[0] - 1))
+        last = elt[0]
+        batch.append(elt)
+        if len(batch) >= batch_size:
+            num += target.apply_changes(batch)
+            batch = []
+    if batch:
+        num += target.apply_changes(batch)
+
+    return num
+
+
+def trim_log(fp, last):
+    """Remove from the end of the change log open for update as fp the
+    lines numbered after last, and a last line with no newline, left by
+    a writer that failed before it committed the changes they record.
+    Returns the number of lines removed.
+    """
+    fp.seek(0, 2)
+    end = fp.tell()
+    keep = end
+    num = 0
+    for pos, line in _lines_backward(fp, end):
+        if line.endswith('\n') and int(line[1:line.index(',')]) <= last:
+            break
+        keep = pos
+        num += 1
+
+    if keep < end:
+        fp.truncate(keep)
+    return num
+
+
+def _lines_backward(fp, end, size=65536):
+    """[private] Generate the (offset, text) pairs of the lines of fp
+    that end at or before offset end, last first, reading size bytes
+    at a time.
+    """
+    buf = ''
+    pos = end
+    while buf or pos > 0:
+        # Find the newline ending the line before the last one in buf.
+        cut = buf.rfind('\n', 0, len(buf) - 1)
+        if cut < 0 and pos > 0:
+            num = min(size, pos)
+            pos -= num
+            fp.seek(pos)
+            buf = fp.read(num) + buf
+            continue
+
+        yield pos + cut + 1, buf[cut + 1:]
+        buf = buf[:cut + 1]
+
+
+__all__ = ('read_log', 'replay_log', 'trim_log')
+
+# Here there be dragons
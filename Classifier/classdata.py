@@ -5,7 +5,52 @@
 ## Copyright (C) 2008 Michael J. Fromberger, All Rights Reserved.
 ##
 
+import hashlib, heapq, itertools, json, os, struct, urllib, zlib
 import sqlite3.dbapi2 as sql
+from changelog import trim_log
+from multiprocessing.pool import ThreadPool
+
+# Maximum number of host parameters bound in a single statement.  The
+# SQLite default limit is 999; stay well under it.
+max_params = 500
+
+# Default maximum number of entries in each of the word caches.
+default_cache_size = 100000
+
+# Whether the SQLite library supports INSERT ... ON CONFLICT DO UPDATE.
+has_upsert = sql.sqlite_version_info >= (3, 24, 0)
+
+# Triggers to keep Words.total equal to the sum of the word's counts,
+# and to stamp Words.seen with the document clock when a count rises.
+# Databases created before these existed are upgraded when opened.
+db_triggers = '''
+CREATE TRIGGER DataInsert
+AFTER INSERT ON Data
+FOR EACH ROW
+BEGIN
+  UPDATE Words SET total = total + NEW.count,
+    seen = coalesce((SELECT CAST(value AS INTEGER) FROM Settings
+                     WHERE name = 'document_clock'), 0)
+  WHERE idNum = NEW.wordID;
+END;
+CREATE TRIGGER DataUpdate
+AFTER UPDATE OF count ON Data
+FOR EACH ROW
+BEGIN
+  UPDATE Words SET total = total - OLD.count + NEW.count,
+    seen = CASE WHEN NEW.count > OLD.count THEN
+      coalesce((SELECT CAST(value AS INTEGER) FROM Settings
+                WHERE name = 'document_clock'), 0)
+      ELSE seen END
+  WHERE idNum = NEW.wordID;
+END;
+CREATE TRIGGER DataDelete
+AFTER DELETE ON Data
+FOR EACH ROW
+BEGIN
+  UPDATE Words SET total = total - OLD.count WHERE idNum = OLD.wordID;
+END;
+'''
 
 db_schema = '''
 CREATE TABLE Classes (
@@ -17,9 +62,10 @@ CREATE TABLE Classes (
 );
 CREATE TABLE Words (
   idNum    INTEGER PRIMARY KEY AUTOINCREMENT,
-  word     VARCHAR(255) UNIQUE NOT NULL,
+  word     %(word_type)s UNIQUE NOT NULL,
   total    INTEGER NOT NULL DEFAULT 0
-           CHECK (total >= 0)
+           CHECK (total >= 0),
+  seen     INTEGER NOT NULL DEFAULT 0
 );
 CREATE TABLE Data (
   wordID   INTEGER REFERENCES Words(idNum),
@@ -44,7 +90,7 @@ FOR EACH ROW
 BEGIN
   DELETE FROM Data WHERE classID = OLD.idNum;
 END;
-'''
+''' + db_triggers
 
 
 class db_group(object):
@@ -52,14 +98,20 @@ class db_group(object):
         self.name = name
         self.id = id
         self.count = count
-        self.dirty = False
+        self.dirty = None
 
     def set_count(self, val):
         self.count = max(val, 0)
-        self.dirty = True
+        self.dirty = ('set', self.count)
 
     def add_count(self, val):
-        self.set_count(self.count + val)
+        self.count = max(self.count + val, 0)
+        if not self.dirty:
+            self.dirty = ('add', val)
+        elif self.dirty[0] == 'set':
+            self.dirty = ('set', self.count)
+        else:
+            self.dirty = ('add', self.dirty[1] + val)
 
     def get_word(self, text):
         return self.source.get_word(self, text)
@@ -85,49 +137,63 @@ class db_group(object):
 
 
 class db_word(object):
-    def __init__(self, text, gid, wid=None):
+    def __init__(self, text, gid, wid=None, count=None):
         self.text = text
         self.gid = gid
         self.wid = wid
-        self.count = None
+        self.stored = count  # count in the database, if known
         self.dirty = None
 
     def set_count(self, val):
         self.dirty = ('set', max(val, 0))
-        self.count = self.dirty[1]
+        self.source._dirty[self.gid, self.text] = self
 
     def add_count(self, val):
-        if self.count is not None:
-            self.set_count(self.count + val)
-        elif self.dirty:
-            self.dirty = (self.dirty[0], self.dirty[1] + val)
-        else:
+        if not self.dirty:
             self.dirty = ('add', val)
+            self.source._dirty[self.gid, self.text] = self
+        elif self.dirty[0] == 'set':
+            self.dirty = ('set', max(self.dirty[1] + val, 0))
+        else:
+            self.dirty = ('add', self.dirty[1] + val)
 
-    def get_count(self):
-        if self.count is None:
+    def get_stored(self):
+        """Return the count for this word as recorded in the database,
+        ignoring any pending changes.
+        """
+        if self.stored is None:
             if self.wid is None:
-                self.count = 0
+                self.stored = 0
             else:
-                cur = self.source._db.cursor()
+                cur = self.source._word_db(self.text).cursor()
                 try:
                     cur.execute(
                         'select count from Data '
                         'where wordID = ? '
                         'and classID = ?', (self.wid, self.gid))
-                    self.count = cur.next()[0]
+                    self.stored = cur.next()[0]
                 except StopIteration:
-                    self.count = 0
+                    self.stored = 0
                 finally:
                     cur.close()
 
-            if self.dirty:
-                self.count += self.dirty[1]
+        return self.stored
 
-        return self.count
+    def get_count(self):
+        """Return the count for this word, including pending changes.
+        A pending adjustment is applied as the database will apply it
+        on commit:  added to the stored count, and limited below by
+        zero.
+        """
+        if not self.dirty:
+            return self.get_stored()
+        elif self.dirty[0] == 'set':
+            return self.dirty[1]
+        else:
+            return max(self.get_stored() + self.dirty[1], 0)
 
     def get_total(self):
-        return self.source._wtot[self.text]
+        return self.source._get_total(self.text)
 
     def __iadd__(self, val):
         self.add_count(val)
@@ -150,16 +216,218 @@ class db_word(object):
         return '<%s:"%s" %s>' % (type(self).__name__, self.text, self.gid)
 
 
+class word_cache(object):
+    """A dictionary holding about limit entries (any number, if limit
+    is None).  When the limit is reached, entries are evicted in
+    approximately least-recently-used order, using the CLOCK scheme:
+    an entry used since the clock hand last passed it is spared once.
+    An entry is never evicted while pinned(value) is true, so pinned
+    entries may hold the cache over its limit until they are released
+    and .trim() is called.  Lookups through .get() and [] count as
+    uses, and are tallied as hits or misses.
+    """
+    def __init__(self, limit=None, pinned=None):
+        self.limit = limit
+        self.pinned = pinned
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = {}
+        self._used = set()  # keys used since the hand last passed
+        self._ring = []  # keys in clock order; may include stale keys
+        self._hand = 0  # index of the next slot to examine
+        self._next = limit  # size at which to look for victims
+
+    def get(self, key, default=None):
+        try:
+            val = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        if self.limit is not None:
+            self._used.add(key)
+        self.hits += 1
+        return val
+
+    def __getitem__(self, key):
+        val = self.get(key, self)
+        if val is self:
+            raise KeyError(key)
+        return val
+
+    def __setitem__(self, key, val):
+        data = self._data
+        if key not in data and self.limit is not None:
+            slot = None
+            if len(data) >= self._next:
+                slot = self._evict()
+            if slot is None:
+                if len(self._ring) > 2 * max(len(data), self.limit):
+                    self._compact()
+                self._ring.append(key)
+            else:
+                self._ring[slot] = key
+        data[key] = val
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def pop(self, key, *default):
+        self._used.discard(key)
+        return self._data.pop(key, *default)
+
+    def trim(self):
+        """Evict entries until the cache is within its limit, or only
+        pinned entries remain.
+        """
+        if self.limit is None:
+            return
+
+        while len(self._data) > self.limit:
+            if self._evict() is None:
+                break
+        if len(self._data) <= self.limit:
+            self._next = self.limit
+
+    def stats(self):
+        """Return a dictionary of usage statistics for the cache."""
+        return dict(size=len(self._data),
+                    limit=self.limit,
+                    hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions)
+
+    def _evict(self):
+        """[private] Advance the clock hand to a slot whose entry may be
+        evicted, evict it, and return the index of the slot.  Returns
+        None if every entry is pinned.
+        """
+        ring, data, used = self._ring, self._data, self._used
+        for i in xrange(2 * len(ring)):
+            if self._hand >= len(ring):
+                self._hand = 0
+            slot = self._hand
+            self._hand += 1
+
+            key = ring[slot]
+            if key not in data:
+                return slot
+            elif key in used:
+                used.discard(key)
+            elif self.pinned is None or not self.pinned(data[key]):
+                del data[key]
+                self.evictions += 1
+                return slot
+
+        # Every entry is pinned; do not search again until the cache
+        # has grown by a fraction of its limit.
+        self._next = len(data) + max(self.limit // 8, 1)
+        return None
+
+    def _compact(self):
+        """[private] Remove stale and duplicate keys from the ring."""
+        seen = set()
+        ring = []
+        for key in self._ring:
+            if key in self._data and key not in seen:
+                seen.add(key)
+                ring.append(key)
+        self._ring = ring
+        self._hand = 0
+
+
 class groupdata(object):
     """Represents a database of classification data.  The database
     stores data for one or more groups, which are indexed by string
     keys.
     """
-    def __init__(self, db_path):
-        """Connect to an existing database or create a new database."""
-        self._db = sql.connect(db_path)
+    def __init__(self,
+                 db_path,
+                 cache_size=default_cache_size,
+                 read_only=False,
+                 wal=False,
+                 mmap_size=None,
+                 sql_cache_size=None,
+                 timeout=5.0,
+                 check_same_thread=True,
+                 word_hash=None,
+                 change_log=None,
+                 shards=None):
+        """Connect to an existing database or create a new database.
+
+        cache_size        -- maximum number of words cached for each group, and
+                             of word totals cached; None for no limit.  Words
+                             with uncommitted changes are kept regardless.
+        read_only         -- if true, open an existing database for reading
+                             only.  No write lock is ever taken, and the schema
+                             is neither created nor upgraded.
+        wal               -- if true, put the database in write-ahead log mode,
+                             so that readers and a writer do not block each
+                             other.  The mode is persistent.
+        mmap_size         -- bytes of the database file to memory-map.
+        sql_cache_size    -- SQLite page cache size; a positive value is a
+                             number of pages, a negative value is KiB.
+        timeout           -- seconds to wait for a lock held by another
+                             connection before failing.
+        check_same_thread -- if false, the object may be used by threads other
+                             than the one that created it; the caller must
+                             ensure only one thread uses it at a time.
+        word_hash         -- how words are stored in a new database:  None
+                             to store their text, 0 to store a 64-bit hash
+                             of each word, or a positive number n to hash
+                             words into n buckets.  For an existing
+                             database, None accepts whatever it uses, and
+                             another value must match it.
+        change_log        -- a file, or the path of one to append to, to
+                             which each commit writes a record of the
+                             changes it makes; see the changelog module.
+                             Given a path, lines a failed writer logged
+                             but did not commit are first removed.
+        shards            -- for a new database, None to store all words
+                             in one file, or the number of files (shards)
+                             among which to divide them.  For an existing
+                             database, None accepts whatever it uses, and
+                             another value must match it.
+
+        A sharded database keeps its groups and settings in the file at
+        db_path, and its words and counts in the files named by
+        shard_paths(db_path, shards); each word is stored in one shard,
+        chosen by a hash of the word.  Lookups of many words, and writes,
+        are issued to the shards in parallel.  A commit is atomic within
+        each file, but not across them.
+        """
+        self._db = None
+        self._log = None
+        self._own_log = False
+        self._shards = None  # connections to the shards, if any
+        self._pool = None  # threads issuing work to the shards
+        self._read_only = read_only
+        self._cache_size = cache_size
+        self._word_hash = word_hash
+        self._num_shards = shards
+        self._timeout = timeout
+        if shards is not None and shards < 1:
+            raise ValueError("Invalid shard count %r" % shards)
+        self._db = self._connect(db_path, timeout, check_same_thread)
+        self._own_log = isinstance(change_log, basestring)
+        if self._own_log:
+            change_log = open(change_log, 'ab')
+        self._log = change_log
         self._path = db_path
 
+        self._pragmas = []
+        if wal and not read_only:
+            self._pragmas.append('journal_mode = wal')
+        if mmap_size is not None:
+            self._pragmas.append('mmap_size = %d' % mmap_size)
+        if sql_cache_size is not None:
+            self._pragmas.append('cache_size = %d' % sql_cache_size)
+        self._configure(self._db)
+
         class group(db_group):
             source = self
 
@@ -171,6 +439,8 @@ class groupdata(object):
 
         self.discard()
         self._check()
+        if self._own_log and not read_only:
+            self._trim_log(change_log.name)
 
     def discard(self):
         """Discard any pending changes without writing them to the
@@ -178,21 +448,131 @@ class groupdata(object):
         """
         if self._db is not None:
             self._db.rollback()
+        for db in self._shards or ():
+            db.rollback()
 
         self._gmap = None  # cache of group data.
-        self._wmap = {}  # cache of word data.
-        self._wtot = {}  # cache of word totals.
+        self._wmap = {}  # caches of word data, by group ID.
+        self._wtot = word_cache(self._cache_size)  # cache of word totals.
+        self._dirty = {}  # changed words, by (group ID, word).
+        self._ticks = 0  # pending advance of the document clock
+        self._log_settings = []  # (name, op, value) of logged settings
+        self._version = self._data_version()  # when caches were emptied
+
+    def _data_version(self):
+        """[private] Return a value that changes whenever another
+        connection commits a change to the database.
+        """
+        if self._db is None:
+            return None
+        return tuple(
+            db.execute('pragma data_version').fetchone()[0]
+            for db in [self._db] + (self._shards or []))
+
+    def refresh(self):
+        """Discard the caches if the database has been changed by
+        another connection since they were emptied, so that later
+        lookups see the new data.  Any pending changes are discarded
+        along with them.  Returns True if the caches were discarded.
+        """
+        if self._data_version() == self._version:
+            return False
+
+        self.discard()
+        return True
+
+    def _new_cache(self):
+        """[private] Return a new, empty word cache."""
+        return word_cache(self._cache_size, pinned=word_pinned)
+
+    def cache_stats(self):
+        """Return a dictionary of usage statistics for the word caches.
+        The 'words' entry combines the caches of all groups; 'totals'
+        is for the word totals.  Each is a dictionary with keys size,
+        limit, hits, misses, and evictions.
+        """
+        words = dict(size=0, limit=0, hits=0, misses=0, evictions=0)
+        for wmap in self._wmap.itervalues():
+            for key, val in wmap.stats().iteritems():
+                words[key] += val or 0
+        if self._cache_size is None:
+            words['limit'] = None
+
+        return dict(words=words, totals=self._wtot.stats())
 
     def __del__(self):
         self.close()
 
+    def _connect(self, db_path, timeout, check_same_thread):
+        """[private] Open a connection to the database at db_path."""
+        opts = dict(timeout=timeout, check_same_thread=check_same_thread)
+        if not self._read_only:
+            return sql.connect(db_path, **opts)
+        return connect_read_only(db_path, **opts)
+
+    def _configure(self, db):
+        """[private] Apply the connection options to db."""
+        for pragma in self._pragmas:
+            db.execute('pragma ' + pragma).fetchall()
+
+    def read_only(self):
+        """Return True if the database was opened read-only."""
+        return self._read_only
+
     def _check(self):
         """[private] Check the database for consistency, and create
         the schema if needed.
         """
-        db = self._db
+        created = self._check_schema(self._db, True)
+        if created is None:
+            self.close()
+            raise TypeError("Incompatible database")
+
+        mode = self.read_setting('word_hash')
+        if mode is not None:
+            mode = int(mode)
+        if self._word_hash not in (None, mode):
+            self.close()
+            raise ValueError("Database word hashing mode is %r" % mode)
+
+        self._word_hash = mode
+        if mode is None:
+            self._key = None
+        else:
+            self._key = self._hash_key
+            self._keys = word_cache(self._cache_size)  # text -> hash key
+
+        num = self.read_setting('shards')
+        if num is not None:
+            num = int(num)
+        if self._num_shards not in (None, num):
+            self.close()
+            raise ValueError("Database shard count is %r" % num)
+
+        self._num_shards = num
+        if num is not None:
+            # The shards are used by the threads of the pool.
+            self._shards = []
+            for path in shard_paths(self._path, num):
+                if not created and not os.path.exists(path):
+                    self.close()
+                    raise TypeError("Missing database shard %s" % path)
+                db = self._connect(path, self._timeout, False)
+                self._shards.append(db)
+                self._configure(db)
+                if self._check_schema(db, False) is None:
+                    self.close()
+                    raise TypeError("Incompatible database shard %s" % path)
+        self._version = self._data_version()
+
+    def _check_schema(self, db, main):
+        """[private] Check the database file connected to db for
+        consistency, and create the schema if needed.  If main is true,
+        the file is the main one, otherwise a shard.  Returns True if
+        the schema was created, False if it was present, or None if the
+        database is not compatible.
+        """
         cur = db.cursor()
-        ok = True
         try:
             tabs = set(
                 s[0] for s in cur.execute('select tbl_name from sqlite_master '
@@ -202,17 +582,69 @@ class groupdata(object):
             # If there are no tables, load in the schema; otherwise,
             # check that the existing structure looks something like
             # what we'd expect, and complain if it doesn't.
-            if not tabs:
-                cur.executescript(db_schema)
-                self._db.commit()
+            if not tabs and not self._read_only:
+                self._create(db, cur, main)
+                return True
             elif tabs != set(('Classes', 'Words', 'Data', 'Settings')):
-                ok = False
+                return None
+            elif not self._read_only:
+                self._upgrade(db, cur)
+            return False
         finally:
             cur.close()
 
-        if not ok:
-            self.close()
-            raise TypeError("Incompatible database")
+    def _create(self, db, cur, main):
+        """[private] Load the schema into a new, empty database.  Only
+        the main file of a database records its settings; a shard
+        records only the document clock.
+        """
+        if self._word_hash is None:
+            word_type = 'VARCHAR(255)'
+        else:
+            word_type = 'INTEGER'
+
+        cur.executescript(db_schema % dict(word_type=word_type))
+        if main and self._word_hash is not None:
+            cur.execute('insert into Settings values (?, ?)',
+                        ('word_hash', str(self._word_hash)))
+        if main and self._num_shards is not None:
+            cur.execute('insert into Settings values (?, ?)',
+                        ('shards', str(self._num_shards)))
+        db.commit()
+
+    def _hash_key(self, text):
+        """[private] Return the hash key for text, memoized."""
+        key = self._keys.get(text)
+        if key is None:
+            key = self._keys[text] = hash_word(text, self._word_hash)
+        return key
+
+    def word_hash(self):
+        """Return the word hashing mode of the database:  None if words
+        are stored as text, 0 if as 64-bit hashes, otherwise the number
+        of hash buckets.
+        """
+        return self._word_hash
+
+    def _upgrade(self, db, cur):
+        """[private] Bring an older database up to the current schema."""
+        cur.execute('pragma table_info(Words)')
+        if 'seen' in set(c[1] for c in cur):
+            return
+
+        # Word totals were formerly written by the client, and words did
+        # not record when they were last trained.  Add the column, let
+        # the triggers maintain both from now on, and recompute the
+        # totals once.
+        cur.execute('alter table Words '
+                    'add column seen INTEGER NOT NULL DEFAULT 0')
+        for name in ('DataInsert', 'DataUpdate', 'DataDelete'):
+            cur.execute('drop trigger if exists %s' % name)
+        cur.executescript(db_triggers)
+        cur.execute('update Words set total = '
+                    '(select coalesce(sum(count), 0) from Data '
+                    'where wordID = Words.idNum)')
+        db.commit()
 
     def path(self):
         """Return the path of the database this object is connected to."""
@@ -223,7 +655,18 @@ class groupdata(object):
         if self._db is not None:
             self.discard()
             self._db.close()
+        for db in self._shards or ():
+            db.close()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+        if self._own_log:
+            self._log.close()
         self._db = None
+        self._log = None
+        self._own_log = False
+        self._shards = None
+        self._pool = None
         self._path = None
 
     def _load_groups(self):
@@ -238,7 +681,7 @@ class groupdata(object):
                 self._wmap = {}
                 for name, id, count in data:
                     self._gmap[name] = self._gcls(name, id, count)
-                    self._wmap[id] = {}
+                    self._wmap[id] = self._new_cache()
             finally:
                 cur.close()
 
@@ -264,23 +707,37 @@ class groupdata(object):
         if name not in self._gmap:
             cur = self._db.cursor()
             try:
-                cur.execute('select max(idNum) from Classes')
-                gid = cur.next()[0]
-                if gid is None:
-                    gid = 1
-                else:
-                    gid += 1
-
-                cur.execute('insert into Classes '
-                            'values (?, ?, ?)', (gid, name, 0))
-                self._db.commit()
-                self._gmap[name] = self._gcls(name, gid, 0)
-                self._wmap[gid] = {}
+                self._insert_group(cur, name)
+                line = self._log_record(cur, dict(groups=[name]))
+                self._commit_logged(line)
+            except:
+                self._rollback()
+                grp = self._gmap.pop(name, None)
+                if grp is not None:
+                    self._wmap.pop(grp.id, None)
+                raise
             finally:
                 cur.close()
 
         return self._gmap[name]
 
+    def _insert_group(self, cur, name):
+        """[private] Add a new group to the database, without
+        committing, and return it.
+        """
+        cur.execute('select max(idNum) from Classes')
+        gid = cur.next()[0]
+        if gid is None:
+            gid = 1
+        else:
+            gid += 1
+
+        cur.execute('insert into Classes '
+                    'values (?, ?, ?)', (gid, name, 0))
+        grp = self._gmap[name] = self._gcls(name, gid, 0)
+        self._wmap[gid] = self._new_cache()
+        return grp
+
     def group_names(self):
         """Return an iterator over the names of the groups defined."""
         self._load_groups()
@@ -293,76 +750,702 @@ class groupdata(object):
 
     def get_word(self, grp, text):
         """Fetch word data.  Returns a word object oriented to the
-        specified group.
+        specified group.  If the database hashes words, the .text of
+        the word object is the hash key, not the given text.
         """
-        if text not in self._wmap[grp.id]:
-            cur = self._db.cursor()
+        if self._key is not None:
+            text = self._key(text)
+
+        wrd = self._wmap[grp.id].get(text)
+        if wrd is None:
+            cur = self._word_db(text).cursor()
             try:
                 cur.execute('select idNum, total from Words '
                             'where word = ?', (text, ))
                 try:
                     idNum, total = cur.next()
-                    self._wmap[grp.id][text] = self._wcls(text, grp.id, idNum)
+                    wrd = self._wcls(text, grp.id, idNum)
                     self._wtot[text] = total
                 except StopIteration:
-                    self._wmap[grp.id][text] = self._wcls(text, grp.id, None)
+                    wrd = self._wcls(text, grp.id, None)
                     self._wtot[text] = 0
             finally:
                 cur.close()
 
-        return self._wmap[grp.id][text]
+            self._wmap[grp.id][text] = wrd
+
+        return wrd
+
+    def get_total(self, text):
+        """Return the total count for the given word over all groups,
+        as recorded in the database.
+        """
+        if self._key is not None:
+            text = self._key(text)
+
+        return self._get_total(text)
+
+    def _get_total(self, text):
+        """[private] As .get_total(), given a word or hash key."""
+        total = self._wtot.get(text)
+        if total is None:
+            cur = self._word_db(text).cursor()
+            try:
+                cur.execute('select total from Words '
+                            'where word = ?', (text, ))
+                total = (cur.fetchone() or (0, ))[0]
+            finally:
+                cur.close()
+
+            self._wtot[text] = total
+
+        return total
+
+    def prefetch(self, words, groups=None, counts=True):
+        """Load word data for each of the given words into the cache,
+        using a few set-based queries in place of one query per word
+        per group.  If groups is given, only those groups are loaded;
+        otherwise all groups are.  If counts is false, the per-group
+        counts are not loaded, only the word IDs and totals.  Words
+        already cached for all the requested groups are skipped.
+        Words not found in the database are cached with a count of
+        zero.
+        """
+        self._load_groups()
+        if groups is None:
+            wmaps = self._wmap
+        else:
+            wmaps = dict((g.id, self._wmap[g.id]) for g in groups)
+        if self._key is not None:
+            words = (self._key(w) for w in words)
+
+        def cached(w):
+            if w not in self._wtot:
+                return False
+            for wm in wmaps.itervalues():
+                wrd = wm.get(w)
+                if wrd is None or (counts and wrd.stored is None):
+                    return False
+            return True
+
+        need = set(w for w in words if not cached(w))
+        if not need:
+            return
+
+        if self._shards is None:
+            wids, data = self._fetch_words(self._db, need, counts)
+        else:
+            wids, data = {}, {}
+            for sw, sd in self._map_shards(self._fetch_words,
+                                           self._by_shard(need), counts):
+                wids.update(sw)
+                data.update(sd)
+
+        for text in need:
+            wid, total = wids.get(text, (None, 0))
+            self._wtot[text] = total
+
+            for gid, wmap in wmaps.iteritems():
+                if wid is None:
+                    stored = 0
+                elif counts:
+                    stored = data.get((text, gid), 0)
+                else:
+                    stored = None
+
+                wrd = wmap.get(text)
+                if wrd is None:
+                    wmap[text] = self._wcls(text, gid, wid, stored)
+                elif wrd.stored is None:
+                    wrd.wid = wid
+                    wrd.stored = stored
+
+    def _fetch_words(self, db, words, counts):
+        """[private] Look up the given words in the database connected
+        to db, and return a pair of dictionaries (wids, data):  wids
+        maps each word found to a tuple (ID, total), and if counts is
+        true, data maps (word, group ID) pairs to their counts.
+        """
+        wids = {}  # :: word -> (idNum, total)
+        data = {}  # :: (word, classID) -> count
+        cur = db.cursor()
+        try:
+            for chunk in chunks(words, max_params):
+                cur.execute(
+                    'select word, idNum, total from Words '
+                    'where word in (%s)' % params(chunk), chunk)
+                for word, idNum, total in cur:
+                    wids[word] = idNum, total
+
+            if counts:
+                text = dict((i, w) for w, (i, t) in wids.iteritems())
+                for chunk in chunks(text, max_params):
+                    cur.execute(
+                        'select wordID, classID, count from Data '
+                        'where wordID in (%s)' % params(chunk), chunk)
+                    for wid, gid, count in cur:
+                        data[text[wid], gid] = count
+        finally:
+            cur.close()
+
+        return wids, data
 
     def commit(self):
-        """Write all changed data back to the database."""
+        """Write all changed data back to the database.  Only the
+        groups and words that have changed since the last commit are
+        written, in bulk.  Adjustments are sent to the database as
+        increments, so committing does not need the prior counts, and
+        writers sharing a database do not overwrite each other.
+        """
+        # The triggers that keep the word totals make each row written
+        # cost a second update.  That makes writing many words a little
+        # slower than when the totals were written directly (measure
+        # with bench/flushbench), but it is what lets several writers
+        # share a database.
+        self._load_groups()
+        dirty = self._dirty.values()
+        new = list(w for w in dirty if w.wid is None)
+
+        # If anything fails, the transaction is rolled back, and the
+        # changes stay pending, so that they can be committed again
+        # without applying the increments twice.
         cur = self._db.cursor()
         try:
-            dts = set()
-            for grp in self._gmap.itervalues():
-                # Write dirty document counts
-                if grp.dirty:
-                    cur.execute(
-                        'update Classes set count = ? '
-                        'where idNum = ?', (grp.count, grp.id))
-
-                # Write dirty word counts and totals
-                for wrd in self._wmap[grp.id].itervalues():
-                    wc = wrd.get_count()
-
-                    if wrd.dirty:
-                        if wrd.dirty[0] == 'set':
-                            self._wtot[wrd.text] = wc
-                        elif wrd.dirty[0] == 'add':
-                            self._wtot[wrd.text] += wrd.dirty[1]
-
-                        dts.add(wrd.text)
-
-                        if wrd.wid is None:
-                            cur.execute(
-                                'insert or ignore into Words(word) '
-                                'values (?)', (wrd.text, ))
-                            cur.execute(
-                                'select idNum from Words '
-                                'where word = ?', (wrd.text, ))
-                            wrd.wid = cur.next()[0]
-
-                        cur.execute(
-                            'insert or replace into Data '
-                            'values (?, ?, ?)', (wrd.wid, wrd.gid, wc))
-            for wrd in dts:
-                cur.execute('update Words set total = ? '
-                            'where word = ?', (self._wtot[wrd], wrd))
+            if self._ticks:
+                self.add_setting('document_clock', self._ticks)
+            groups = list(g for g in self._gmap.itervalues() if g.dirty)
+            self._write_changes(cur, groups, dirty)
+            line = None
+            if self._log is not None:
+                line = self._log_record(cur,
+                                        self._change_record(groups, dirty))
+            self._commit_logged(line)
+        except:
+            self._rollback()
+            for wrd in new:
+                wrd.wid = None
+            raise
+        finally:
+            cur.close()
+        self._ticks = 0
+
+        # Update the caches and clear the dirty flags now that the data
+        # are committed.  Adjusted counts and totals are reloaded from
+        # the database when next needed.
+        for grp in self._gmap.itervalues():
+            grp.dirty = None
+        for wrd in dirty:
+            if wrd.dirty[0] == 'set':
+                wrd.stored = wrd.dirty[1]
+            else:
+                wrd.stored = None
+            wrd.dirty = None
+            self._wtot.pop(wrd.text, None)
+        self._dirty = {}
+        for wmap in self._wmap.itervalues():
+            wmap.trim()
+
+    def _write_changes(self, cur, groups, words):
+        """[private] Write the changes to the given groups and words,
+        without committing.
+        """
+        self._write_groups(cur, groups)
+        if self._shards is None:
+            self._store_words(cur, words)
+            return
+
+        # Each shard stamps the words it writes with a copy of the
+        # document clock, which is kept in the main file.
+        clock = self.read_setting('document_clock')
+        self._map_shards(self._write_shard,
+                         self._by_shard(words, lambda w: w.text), clock)
+
+    def _write_shard(self, db, words, clock):
+        """[private] Write the changes to the given words, all stored
+        in the shard connected to db, without committing.  The copy of
+        the document clock kept by the shard is first set to clock.
+        """
+        cur = db.cursor()
+        try:
+            if clock is not None:
+                cur.execute('insert or replace into Settings '
+                            'values (?, ?)', ('document_clock', clock))
+            self._store_words(cur, words)
+        finally:
+            cur.close()
 
+    def _store_words(self, cur, words):
+        """[private] Write the changes to the given words, adding any
+        new words to the Words table.
+        """
+        # Word totals are maintained by triggers on the Data table.
+        new = set(w.text for w in words if w.wid is None)
+        cur.executemany('insert or ignore into Words(word) '
+                        'values (?)', ((t, ) for t in new))
+        wids = self._word_ids(cur, new)
+        for wrd in words:
+            if wrd.wid is None:
+                wrd.wid = wids[wrd.text]
+
+        self._write_words(cur, words)
+
+    def _commit(self):
+        """[private] Commit the open transactions of the shards, if
+        any, and then of the main file.
+        """
+        if self._shards is not None:
+            self._map_shards(lambda db, part: db.commit(),
+                             list(enumerate(self._shards)))
+        self._db.commit()
+
+    def _rollback(self):
+        """[private] Roll back the open transactions of the main file
+        and of the shards, if any.  A shard that has already committed
+        keeps its changes; see .__init__().  Changes to settings made in
+        the transactions are no longer logged.
+        """
+        self._db.rollback()
+        for db in self._shards or ():
+            db.rollback()
+        self._log_settings = []
+
+    def _word_db(self, key):
+        """[private] Return the connection to the file storing the word
+        with the given key.
+        """
+        if self._shards is None:
+            return self._db
+        return self._shards[shard_index(key, len(self._shards))]
+
+    def _by_shard(self, items, key=None):
+        """[private] Divide items among the shards by the words key(item)
+        (or the items themselves, if key is None).  Returns a list of
+        (shard index, list of items) pairs, omitting empty lists.
+        """
+        num = len(self._shards)
+        parts = {}
+        for item in items:
+            pos = shard_index(item if key is None else key(item), num)
+            parts.setdefault(pos, []).append(item)
+        return parts.items()
+
+    def _map_shards(self, func, parts, *args):
+        """[private] Call func(db, part, *args) for each (shard index,
+        part) pair of parts, with db the connection to that shard, and
+        return a list of the results.  The calls are made in parallel.
+        """
+        if len(parts) == 1:
+            pos, part = parts[0]
+            return [func(self._shards[pos], part, *args)]
+        if self._pool is None:
+            self._pool = ThreadPool(len(self._shards))
+
+        return self._pool.map(
+            lambda (pos, part): func(self._shards[pos], part, *args), parts)
+
+    def _change_record(self, groups, words):
+        """[private] Return a change record for a commit of the given
+        groups and words.
+        """
+        names = dict((g.id, g.name) for g in self._gmap.itervalues())
+        rec = {}
+        if groups:
+            rec['docs'] = dict((g.name, list(g.dirty)) for g in groups)
+        for wrd in words:
+            op, val = wrd.dirty
+            if op == 'add' and val == 0:
+                continue
+            rec.setdefault(op, {}).setdefault(names[wrd.gid], []).append(
+                [wrd.text, val])
+
+        return rec
+
+    def _log_record(self, cur, rec):
+        """[private] Return the line to append to the change log for a
+        transaction making the changes in rec, and advance the log
+        sequence number within it.  Returns None if changes are not
+        logged, or if rec and the pending settings change nothing.
+        """
+        if self._log is None:
+            return None
+        if self._log_settings:
+            rec['settings'] = self._log_settings
+            self._log_settings = []
+        if not rec:
+            return None
+
+        cur.execute("insert or ignore into Settings "
+                    "values ('log_sequence', '0')")
+        cur.execute("update Settings "
+                    "set value = cast(value as integer) + 1 "
+                    "where name = 'log_sequence'")
+        seq = int(
+            cur.execute("select value from Settings "
+                        "where name = 'log_sequence'").fetchone()[0])
+        rec['hash'] = self._word_hash
+        return json.dumps([seq, rec], separators=(',', ':')) + '\n'
+
+    def _commit_logged(self, line):
+        """[private] Append line to the change log, unless it is None,
+        and then commit.  The line is on disk before the commit, so a
+        failure between the two leaves the log ahead of the database
+        (see ._trim_log()), never behind it.  If the commit fails, the
+        line is removed again; no other writer can have logged anything
+        meanwhile, as the transaction holds the database's write lock.
+        The transaction is then rolled back, with the advance of the log
+        sequence number it made, so the next line logged takes the same
+        number.
+        """
+        if line is None:
+            self._commit()
+            return
+
+        self._log.flush()
+        fd = self._log.fileno()
+        pos = os.fstat(fd).st_size
+        self._log.write(line)
+        self._log.flush()
+        os.fsync(fd)
+        try:
+            self._commit()
+        except sql.Error:
+            os.ftruncate(fd, pos)
+            self._rollback()
+            raise
+
+    def _trim_log(self, path):
+        """[private] Remove from the end of the change log at path the
+        lines of transactions that were logged but never committed.
+        The database is locked for writing meanwhile, so that no other
+        writer is between logging and committing a transaction.
+        """
+        self._db.execute('begin immediate')
+        try:
+            with open(path, 'r+b') as fp:
+                trim_log(fp, self.log_sequence())
+        finally:
             self._db.commit()
 
-            # Clear all the dirty flags now that the data are committed
-            for grp in self._gmap.itervalues():
-                grp.dirty = False
-                for wrd in self._wmap[grp.id].itervalues():
-                    wrd.dirty = None
+    def log_sequence(self):
+        """Return the sequence number of the last change record logged
+        by or applied to the database, or 0 if there is none.
+        """
+        return int(self.read_setting('log_sequence', 0))
+
+    def apply_changes(self, records):
+        """Apply a sequence of (sequence number, change record) pairs
+        read from a change log (see the changelog module) in a single
+        transaction, and return the number of records applied.  Pending
+        changes are committed first.
+
+        The records must continue from .log_sequence() without gaps,
+        and must have been logged by a database that hashes words the
+        same way as this one; if not, ValueError is raised and nothing
+        is applied.  The changes applied are not themselves logged.
+        """
+        self.commit()
+        self._load_groups()
+        last = self.log_sequence()
+        num = 0
+        cur = self._db.cursor()
+        try:
+            for seq, rec in records:
+                if seq != last + 1:
+                    raise ValueError("Change record %d does not follow %d" %
+                                     (seq, last))
+                if rec.get('hash') != self._word_hash:
+                    raise ValueError("Change record %d word hashing mode "
+                                     "is %r" % (seq, rec.get('hash')))
+                self._apply_record(cur, rec)
+                last = seq
+                num += 1
+
+            cur.execute('insert or replace into Settings '
+                        'values (?, ?)', ('log_sequence', str(last)))
+            self._commit()
+        except:
+            self._rollback()
+            raise
+        finally:
+            cur.close()
+            self.discard()
+
+        return num
 
+    def _apply_record(self, cur, rec):
+        """[private] Write the changes in a change record, without
+        committing.  The changes are applied in the order the commit
+        that logged them made them.
+        """
+        for key, op, val in rec.get('settings', ()):
+            if op == 'add':
+                self.add_setting(key, val)
+            else:
+                self.write_setting(key, val)
+
+        def group(name):
+            grp = self._gmap.get(name)
+            if grp is None:
+                grp = self._insert_group(cur, name)
+            return grp
+
+        for name in rec.get('groups', ()):
+            group(name)
+
+        groups = []
+        for name, (op, val) in rec.get('docs', {}).iteritems():
+            grp = self._gcls(name, group(name).id, 0)
+            grp.dirty = (op, val)
+            groups.append(grp)
+
+        words = []
+        for op in ('set', 'add'):
+            for name, pairs in rec.get(op, {}).iteritems():
+                gid = group(name).id
+                for text, val in pairs:
+                    wrd = self._wcls(text, gid)
+                    wrd.dirty = (op, val)
+                    words.append(wrd)
+
+        self._write_changes(cur, groups, words)
+        if 'compact' in rec:
+            self._compact(cur, **rec['compact'])
+
+    def tick(self, num=1):
+        """Advance the document clock by num documents at the next
+        commit.  Words whose counts rise in a commit are stamped with
+        the clock, for use by .compact().
+        """
+        self._ticks += num
+
+    def clock(self):
+        """Return the document clock, including pending advances."""
+        return int(self.read_setting('document_clock', 0)) + self._ticks
+
+    def compact(self, min_total=None, max_age=None, max_words=None,
+                vacuum=True):
+        """Remove little-used words from the database, and reclaim the
+        space they occupied.  Pending changes are committed first.
+
+        min_total -- remove words whose total count is less than this.
+        max_age   -- remove words not trained within this many documents
+                     of the document clock (see .tick()).
+        max_words -- remove the words with the lowest totals (the least
+                     recently trained first, among equals, then in order
+                     of the words) until at most this many remain.
+        vacuum    -- if true, rebuild the indexes and vacuum the file.
+
+        Orphaned and zero counts, and words with no counts, are always
+        removed.  Returns a dictionary giving the numbers of words and
+        counts removed, and the size of the database in bytes before
+        and after.
+        """
+        self.commit()
+        before = self._db_size()
+        limits = dict(min_total=min_total, max_age=max_age,
+                      max_words=max_words)
+        cur = self._db.cursor()
+        try:
+            stats = self._compact(cur, **limits)
+            line = self._log_record(cur, dict(compact=limits))
+            self._commit_logged(line)
+        except:
+            self._rollback()
+            raise
         finally:
             cur.close()
 
+        if vacuum:
+            for db in [self._db] + (self._shards or []):
+                db.execute('reindex')
+                db.execute('vacuum')
+
+        self.discard()
+        stats.update(size_before=before, size_after=self._db_size())
+        return stats
+
+    def _compact(self, cur, min_total, max_age, max_words):
+        """[private] Remove words as for .compact(), without committing;
+        returns the numbers of words and counts removed.
+        """
+        if self._shards is not None:
+            return self._compact_shards(min_total, max_age, max_words)
+
+        nwords = cur.execute('select count(*) from Words').fetchone()[0]
+        ndata = cur.execute('select count(*) from Data').fetchone()[0]
+
+        cur.execute('delete from Data where count <= 0 '
+                    'or wordID not in (select idNum from Words) '
+                    'or classID not in (select idNum from Classes)')
+        if min_total is not None:
+            cur.execute('delete from Words where total < ?', (min_total, ))
+        if max_age is not None:
+            cur.execute('delete from Words where seen < ?',
+                        (self.clock() - max_age, ))
+        if max_words is not None:
+            cur.execute(
+                'delete from Words where idNum in '
+                '(select idNum from Words order by total, seen, word '
+                'limit max((select count(*) from Words) - ?, 0))',
+                (max_words, ))
+        cur.execute('delete from Words where idNum not in '
+                    '(select wordID from Data)')
+
+        return dict(
+            words=nwords - cur.execute('select count(*) from Words'
+                                       ).fetchone()[0],
+            counts=ndata - cur.execute('select count(*) from Data'
+                                       ).fetchone()[0])
+
+    def _compact_shards(self, min_total, max_age, max_words):
+        """[private] As ._compact(), for a sharded database."""
+        gids = list(g.id for g in self.all_groups())
+        seen = None if max_age is None else self.clock() - max_age
+
+        def sizes(db):
+            return tuple(
+                db.execute('select count(*) from %s' % tab).fetchone()[0]
+                for tab in ('Words', 'Data'))
+
+        def prune(db, part):
+            before = sizes(db)
+            db.execute(
+                'delete from Data where count <= 0 '
+                'or wordID not in (select idNum from Words) '
+                'or classID not in (%s)' % params(gids), gids)
+            if min_total is not None:
+                db.execute('delete from Words where total < ?', (min_total, ))
+            if seen is not None:
+                db.execute('delete from Words where seen < ?', (seen, ))
+            return before
+
+        def lowest(db, part):
+            return list((t, s, w, part, wid) for t, s, w, wid in db.execute(
+                'select total, seen, word, idNum from Words '
+                'order by total, seen, word limit ?', (num, )))
+
+        def drop(db, wids):
+            for chunk in chunks(wids, max_params):
+                db.execute('delete from Words where idNum in (%s)' %
+                           params(chunk), chunk)
+
+        def finish(db, part):
+            db.execute('delete from Words where idNum not in '
+                       '(select wordID from Data)')
+            return sizes(db)
+
+        every = list(enumerate(self._shards))
+        before = self._map_shards(prune, every)
+
+        # Remove the words with the lowest totals over all the shards,
+        # as if they were in one database.
+        if max_words is not None:
+            num = max(sum(n for n, d in self._map_shards(
+                lambda db, part: sizes(db), every)) - max_words, 0)
+            if num > 0:
+                rows = heapq.nsmallest(num, itertools.chain.from_iterable(
+                    self._map_shards(lowest, list((i, i) for i, db in every))))
+                wids = {}
+                for t, s, w, pos, wid in rows:
+                    wids.setdefault(pos, []).append(wid)
+                self._map_shards(drop, wids.items())
+
+        after = self._map_shards(finish, every)
+        return dict(words=sum(b[0] - a[0] for b, a in zip(before, after)),
+                    counts=sum(b[1] - a[1] for b, a in zip(before, after)))
+
+    def _db_size(self):
+        """[private] Return the size of the database in bytes."""
+        size = 0
+        for db in [self._db] + (self._shards or []):
+            pages = db.execute('pragma page_count').fetchone()[0]
+            size += pages * db.execute('pragma page_size').fetchone()[0]
+        return size
+
+    def _write_groups(self, cur, groups):
+        """[private] Write the document counts of the given groups."""
+        cur.executemany(
+            'update Classes set count = ? '
+            'where idNum = ?',
+            list((g.dirty[1], g.id) for g in groups if g.dirty[0] == 'set'))
+        cur.executemany(
+            'update Classes set count = max(count + ?, 0) '
+            'where idNum = ?',
+            list((g.dirty[1], g.id) for g in groups if g.dirty[0] == 'add'))
+
+    def _write_words(self, cur, words):
+        """[private] Write the counts of the given words, all of which
+        must have IDs.  Counts that fall to zero are removed, since the
+        schema does not allow them.
+        """
+        sets, incs, decs = [], [], []
+        known = []  # increments to rows known to exist
+        for wrd in words:
+            op, val = wrd.dirty
+            if op == 'set':
+                sets.append((val, wrd.wid, wrd.gid))
+            elif val > 0 and wrd.stored:
+                known.append((val, wrd.wid, wrd.gid))
+            elif val > 0:
+                incs.append((val, wrd.wid, wrd.gid))
+            elif val < 0:
+                decs.append((-val, wrd.wid, wrd.gid))
+
+        # A plain update is enough for rows whose counts were loaded.
+        # If another writer has since removed some of them, the row
+        # count falls short, and the missing rows are inserted.  Rows
+        # of unknown existence cost about the same with an upsert, but
+        # twice as much without one (see bench/flushbench).
+        if known:
+            cur.executemany('update Data set count = count + ? '
+                            'where wordID = ? and classID = ?', known)
+            if cur.rowcount != len(known):
+                cur.executemany(
+                    'insert or ignore into Data(count, wordID, classID) '
+                    'values (?, ?, ?)', known)
+
+        cur.executemany('update Data set count = ? '
+                        'where wordID = ? and classID = ?',
+                        list(r for r in sets if r[0] > 0))
+        cur.executemany('insert or ignore into Data(count, wordID, classID) '
+                        'values (?, ?, ?)', list(r for r in sets if r[0] > 0))
+        cur.executemany('delete from Data '
+                        'where wordID = ? and classID = ?',
+                        list(r[1:] for r in sets if r[0] == 0))
+
+        if has_upsert:
+            cur.executemany(
+                'insert into Data(count, wordID, classID) '
+                'values (?, ?, ?) on conflict (wordID, classID) '
+                'do update set count = count + excluded.count', incs)
+        else:
+            cur.executemany(
+                'update Data set count = count + ? '
+                'where wordID = ? and classID = ?', incs)
+            cur.executemany(
+                'insert or ignore into Data(count, wordID, classID) '
+                'values (?, ?, ?)', incs)
+
+        cur.executemany(
+            'delete from Data '
+            'where count <= ? and wordID = ? and classID = ?', decs)
+        cur.executemany(
+            'update Data set count = count - ? '
+            'where wordID = ? and classID = ?', decs)
+
+    def _word_ids(self, cur, words):
+        """[private] Return a dictionary mapping each of the given words
+        to its ID in the Words table.  Words not present are omitted.
+        """
+        ids = {}
+        for chunk in chunks(words, max_params):
+            cur.execute(
+                'select word, idNum from Words '
+                'where word in (%s)' % params(chunk), chunk)
+            ids.update(cur)
+
+        return ids
+
     def read_setting(self, key, default=None):
         """Read the value of a database setting; returns default if
         the setting is not defined.
@@ -391,6 +1474,26 @@ class groupdata(object):
                             'values (?, ?)', (key, value))
         finally:
             cur.close()
+        if self._log is not None:
+            self._log_settings.append((key, 'set', value))
+
+    def add_setting(self, key, delta):
+        """Add delta to the integer value of a database setting, which
+        is taken to be zero if not defined.  The result is limited
+        below by zero.
+        """
+        cur = self._db.cursor()
+        try:
+            cur.execute('insert or ignore into Settings '
+                        'values (?, ?)', (key, '0'))
+            cur.execute(
+                'update Settings '
+                'set value = max(cast(value as integer) + ?, 0) '
+                'where name = ?', (delta, key))
+        finally:
+            cur.close()
+        if self._log is not None:
+            self._log_settings.append((key, 'add', delta))
 
     def __len__(self):
         self._load_groups()
@@ -406,6 +1509,74 @@ class groupdata(object):
         return '#<%s "%s">' % (type(self).__name__, self._path)
 
 
+def word_pinned(wrd):
+    """Return true if wrd has changes that are not yet committed."""
+    return wrd.dirty is not None
+
+
+def hash_word(text, buckets=0):
+    """Return the integer key for text when words are stored hashed:
+    the first 64 bits of its MD5 digest as a signed integer, reduced
+    modulo buckets if that is positive.  Unicode text is hashed as
+    UTF-8.
+    """
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    key = struct.unpack('<q', hashlib.md5(text).digest()[:8])[0]
+    if buckets > 0:
+        key %= buckets
+    return key
+
+
+def connect_read_only(db_path, **opts):
+    """Open a connection to the existing database at db_path, which
+    refuses writes.  Other keyword options are passed to connect().
+    Raises sqlite3.OperationalError if there is no such database.
+    """
+    # Prefer a read-only URI, so that SQLite itself refuses writes.
+    # Versions of the sqlite3 module that do not accept URIs get a
+    # connection restricted by the query_only pragma instead.
+    uri = 'file:%s?mode=ro' % urllib.quote(os.path.abspath(db_path))
+    try:
+        db = sql.connect(uri, uri=True, **opts)
+    except TypeError:
+        if not os.path.exists(db_path):
+            raise sql.OperationalError("unable to open database file")
+        db = sql.connect(db_path, **opts)
+    db.execute('pragma query_only = 1')
+    return db
+
+
+def shard_paths(db_path, num):
+    """Return the paths of the files storing the words of a database at
+    db_path divided among num shards.
+    """
+    return list('%s.shard%d' % (db_path, pos) for pos in xrange(num))
+
+
+def shard_index(key, num):
+    """Return the index of the shard storing the word with the given
+    key (its text, or its hash), among num shards.
+    """
+    if isinstance(key, (int, long)):
+        return key % num
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return (zlib.crc32(key) & 0xffffffff) % num
+
+
+def chunks(seq, size):
+    """Generate successive lists of at most size elements from seq."""
+    seq = list(seq)
+    for pos in xrange(0, len(seq), size):
+        yield seq[pos:pos + size]
+
+
+def params(seq):
+    """Return a list of SQL parameter markers, one per element of seq."""
+    return ', '.join('?' * len(seq))
+
+
 __all__ = ('groupdata', )
 
 # Here there be dragons
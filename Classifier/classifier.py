@@ -7,8 +7,10 @@
 
 from __future__ import division
 
-import classdata
+import classdata, heapq, math, textparsers
 from decimal import Decimal as D
+from fractions import Fraction
+from operator import itemgetter
 
 
 class classifier(classdata.groupdata):
@@ -48,24 +50,60 @@ class classifier(classdata.groupdata):
 
 
 class trainer(classdata.groupdata):
-    """Updates a training set based on new input documents."""
-    def increment_doc_count(self):
-        """Add 1 to the overall document count for the training
-        set.
+    """Updates a training set based on new input documents.
+
+    Each call to .train() or .untrain() normally commits its changes
+    to the database.  Within a session (see .session()), changes are
+    instead accumulated in memory and written in larger batches.
+    """
+    _session = None  # active training_session, if any
+
+    def discard(self):
+        super(trainer, self).discard()
+        self._doc_count = None  # cached stored document count
+        self._doc_delta = 0  # pending change to the document count
+
+    def commit(self):
+        if self._doc_delta:
+            self.add_setting('document_count', self._doc_delta)
+        super(trainer, self).commit()
+
+        self._doc_count = None
+        self._doc_delta = 0
+
+    def session(self, max_docs=1000, max_bytes=None):
+        """Return a context manager for a training session.  Within the
+        session, .train() and .untrain() do not commit; the changes are
+        written when max_docs documents or max_bytes bytes of word text
+        have accumulated (either may be None for no limit), and when
+        the session ends.  If the session ends with an exception, all
+        changes since the last write are discarded.
+
+        with cls.session(max_docs=500):
+            for doc in docs:
+                cls.train(doc, groups)
+        """
+        return training_session(self, max_docs, max_bytes)
+
+    def increment_doc_count(self, num=1):
+        """Add num (default 1) to the overall document count for the
+        training set.
         """
-        old = self.get_doc_count()
-        self.write_setting('document_count', str(old + 1))
+        self._doc_delta += num
 
-    def decrement_doc_count(self):
-        """Subtract 1 from the overall document count for the training
-        set.
+    def decrement_doc_count(self, num=1):
+        """Subtract num (default 1) from the overall document count for
+        the training set.
         """
-        old = self.get_doc_count()
-        self.write_setting('document_count', str(max(old - 1, 0)))
+        self._doc_delta -= num
 
     def get_doc_count(self):
-        """Retrieve the current document count."""
-        return int(self.read_setting('document_count', 0))
+        """Retrieve the current document count, including any changes
+        not yet committed.
+        """
+        if self._doc_count is None:
+            self._doc_count = int(self.read_setting('document_count', 0))
+        return max(self._doc_count + self._doc_delta, 0)
 
     def train(self, input, groups, is_new=True):
         """Given an input sequence of (word, count) pairs, up-regulate
@@ -73,42 +111,71 @@ class trainer(classdata.groupdata):
         true, this is assumed to be a new document, and the document
         count is incremented.
         """
-        groups = list(self.get_group(g) for g in groups)
-
-        for word, count in input:
-            for group in groups:
-                w = group.get_word(word)
-                w += count
-
-        self.commit()
-
-        if is_new:
-            for group in groups:
-                group += 1
-
-            self.increment_doc_count()
-            self.commit()
+        self._apply(input, groups, 1, 1, is_new)
 
     def untrain(self, input, groups, remove=False):
         """Given an input sequence of (word, count) pairs, down-
         regulate the training data for the specified groups.  If
         remove is true, the document count is decremented.
         """
+        self._apply(input, groups, -1, 1, remove)
+
+    def train_many(self, inputs, groups, is_new=True):
+        """Given a sequence of inputs, each a sequence of (word, count)
+        pairs, up-regulate the training data for the specified groups
+        as if each input were given to .train(), but merge them into a
+        single update that is written in one transaction.  Returns the
+        number of inputs.
+        """
+        delta, num = merge_counts(inputs)
+        self._apply(delta.iteritems(), groups, 1, num, is_new)
+        return num
+
+    def untrain_many(self, inputs, groups, remove=False):
+        """As .train_many(), but down-regulates the training data as if
+        each input were given to .untrain().  Returns the number of
+        inputs.
+        """
+        delta, num = merge_counts(inputs)
+        self._apply(delta.iteritems(), groups, -1, num, remove)
+        return num
+
+    def _apply(self, input, groups, sign, num, adjust):
+        """[private] Add sign * count to the data for each (word, count)
+        pair of input, in each of the named groups.  The input stands
+        for num documents; if adjust is true, the document counts are
+        also changed by sign * num.  The changes are then committed, or
+        handed to the active session.
+        """
         groups = list(self.get_group(g) for g in groups)
 
+        # Training does not depend on the order of the input, so take
+        # the pairs unordered from inputs that can supply them so.
+        if hasattr(input, 'iteritems'):
+            input = input.iteritems()
+        input = list(input)
+        self.prefetch((w for w, c in input), groups, counts=False)
+
         for word, count in input:
             for group in groups:
                 w = group.get_word(word)
-                w -= count
+                w += sign * count
 
-        self.commit()
-
-        if remove:
+        if sign > 0:
+            self.tick(num)
+        if adjust and num > 0:
             for group in groups:
-                group -= 1
+                group += sign * num
+
+            if sign > 0:
+                self.increment_doc_count(num)
+            else:
+                self.decrement_doc_count(num)
 
-            self.decrement_doc_count()
+        if self._session is None:
             self.commit()
+        else:
+            self._session.add(num, sum(len(w) for w, c in input))
 
     def retrain(self, input, old_groups, new_groups):
         """Given a sequence of (word, count) pairs, reregulate the
@@ -120,60 +187,260 @@ class trainer(classdata.groupdata):
         self.train(input, new_groups, is_new=False)
 
 
-class hmm_classifier(classifier, trainer):
-    """Classifies using a simple Hidden Markov model.
+class hmm_model(object):
+    """Scoring rules for a simple Hidden Markov model.  This class is
+    a mixin that implements the classification protocol given a
+    subclass that provides ._feature_table(), len() for the number of
+    groups, and .group_names().
 
-    The classifier selects only the most interesting features, and
-    treats novel features as having a small but nonzero probability of
+    The model selects only the most interesting features, and treats
+    novel features as having a small but nonzero probability of
     occurring in any class in which they are not represented.
+
+    The feature records for each word are cached between documents.
+    A record depends only on the counts of its word and the number of
+    groups, so the cache is emptied when the number of groups changes;
+    subclasses whose training data change must call ._forget_features()
+    with the words that changed, or ._clear_features() if they cannot
+    tell which did.
+
+    By default all arithmetic is done with Decimal values.  If log_space
+    is true, the model instead scores with native floats, summing
+    log-probabilities; the values reported by .result() are then the
+    natural logarithms of the Decimal scores.  Both paths select exactly
+    the same features, so the float scores agree with the logarithms of
+    the Decimal scores to within a relative error of about 1e-15, and
+    the rankings agree unless two groups score that close together.
     """
-    def __init__(self, db_path, feat_th=D('0.1'), feat_min=15, eps=D('0.01')):
-        """Initializes a new HMM classifier.
+    def __init__(self,
+                 feat_th=D('0.1'),
+                 feat_min=15,
+                 eps=D('0.01'),
+                 log_space=False,
+                 cache_size=classdata.default_cache_size):
+        """Initializes the model parameters.
 
-        db_path    -- where the database file is located.
         feat_th    -- percent of features to keep, (0,..1]
         feat_min   -- minimum number of features to keep.
         eps        -- probability imputed to unrepresented features.
+        log_space  -- if true, score with floats in log-probability space.
+        cache_size -- maximum number of words whose features are cached.
         """
-        super(hmm_classifier, self).__init__(db_path)
-
         self._feat_th = feat_th
         self._feat_min = feat_min
         self._epsilon = eps
+        self._log_space = log_space
+        self._feature_cache_size = cache_size
+        self._clear_features()
 
     def start(self):
         # Initial probability distribution is naively assumed uniform
         try:
-            self._uniform = D('1.0') / len(self)
+            n = len(self)
+            self._uniform = D('1.0') / n
         except ZeroDivisionError:
             raise TypeError("No classification groups are defined")
 
-        self._probmap = dict((g, self._uniform) for g in self.group_names())
+        # Cached features depend on the number of groups.
+        if n != self._feature_groups:
+            self._clear_features()
+            self._feature_groups = n
+
+        if self._log_space:
+            init = math.log(self._uniform)
+            self._ngroups = n
+            self._eps_key = float(
+                abs(Fraction(self._epsilon) - Fraction(1, n)))
+            self._log_eps = math.log(self._epsilon)
+        else:
+            init = self._uniform
+
+        self._probmap = dict((g, init) for g in self.group_names())
 
     def update(self, input):
         # Step through the Markov state space
-        for group in self.all_groups():
-            words = list([group[w], D(group[w].get_count())] for w, c in input)
+        table = self._feature_records(w for w, c in input)
+        for name, feats in table.iteritems():
+            self._update_group(name, list(feats[w] for w, c in input))
+
+    def classify_many(self, docs, batch_size=256):
+        """Classify each of a sequence of documents, each given as a
+        sequence of (word, count) pairs.  Generates one result per
+        document, in input order, as for .finish().
+
+        Documents are read in batches of batch_size.  The vocabulary of
+        each batch is looked up once, and the feature data for each
+        word are shared among all the documents that use it.
+        """
+        batch = []
+        for doc in docs:
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                for res in self._classify_batch(batch):
+                    yield res
+                batch = []
+
+        for res in self._classify_batch(batch):
+            yield res
+
+    def _classify_batch(self, docs):
+        """[private] Classify a list of documents; see .classify_many()."""
+        if not docs:
+            return
 
-            # Select the "most interesting" features from the input
-            # for this category.  A feature is more interesting the
-            # further from 0.5 its membership probability lies.
+        self.start()
+        table = self._feature_records(w for doc in docs for w, c in doc)
+        for doc in docs:
+            self.start()
+            for name, feats in table.iteritems():
+                self._update_group(name, list(feats[w] for w, c in doc))
+
+            yield self.finish()
+
+    def _clear_features(self):
+        """[private] Discard all cached feature records."""
+        self._features = classdata.word_cache(self._feature_cache_size)
+        self._feature_groups = None  # number of groups when cached
+
+    def _forget_features(self, keys):
+        """[private] Discard the cached feature records of the words with
+        the given keys (see ._feature_key).
+        """
+        for key in keys:
+            self._features.pop(key, None)
 
-            for w in words:
-                t = w[0].get_total()
-                if t == 0:
-                    w[1] = self._epsilon
-                else:
-                    w[1] /= t
+    # If not None, a function mapping each word to the key its feature
+    # record is cached by; words with the same key share a record.
+    _feature_key = None
 
-            words.sort(key=lambda s: abs(s[-1] - self._uniform), reverse=True)
-            nkeep = int(max(self._feat_th * len(words), self._feat_min))
+    def _cache_features(self):
+        """[private] Return true if feature records may be cached now."""
+        return True
 
-            for w, p in words[:nkeep]:
-                if p == 0:
-                    self._probmap[group.name] *= self._epsilon
-                else:
-                    self._probmap[group.name] *= p
+    def _feature_records(self, words):
+        """[private] As ._feature_table(), but reuses the records cached
+        for words seen before.
+        """
+        if not self._cache_features():
+            return self._feature_table(set(words))
+
+        cache, key = self._features, self._feature_key
+        found, need = {}, []
+        for w in set(words):
+            recs = cache.get(w if key is None else key(w))
+            if recs is None:
+                need.append(w)
+            else:
+                found[w] = recs
+
+        table = self._feature_table(need)
+        for w in need:
+            found[w] = cache[w if key is None else key(w)] = dict(
+                (name, feats[w]) for name, feats in table.iteritems())
+
+        return dict((name, dict((w, recs[name])
+                                for w, recs in found.iteritems()))
+                    for name in self.group_names())
+
+    def _feature_table(self, words):
+        """[private] Given an iterable of words, return a dictionary
+        mapping each group name to a dictionary from each word to its
+        feature record, as given by ._feature().  Subclasses must
+        override this method to supply the training data.
+        """
+        raise NotImplementedError(
+            "Required override ._feature_table() missing")
+
+    def _feature(self, count, total):
+        """[private] Return the scoring record for a word that occurs
+        count times in a group, out of total times overall.  This may
+        only be called after .start().
+        """
+        if self._log_space:
+            # Features are ranked by their exact distance from uniform,
+            # computed as a ratio of integers so that equal distances
+            # compare equal.
+            if total == 0:
+                return (self._eps_key, self._log_eps, count, total)
+            n = self._ngroups
+            key = abs(n * count - total) / (n * total)
+            if count == 0:
+                return (key, self._log_eps, count, total)
+            return (key, math.log(count / total), count, total)
+        else:
+            if total == 0:
+                p = self._epsilon
+            else:
+                p = D(count) / total
+            return (abs(p - self._uniform), p)
+
+    def _update_group(self, name, feats):
+        """[private] Fold a list of feature records for the input into
+        the score for the named group.
+        """
+        if self._log_space:
+            self._probmap[name] = self._log_score(self._probmap[name], feats)
+        else:
+            self._probmap[name] = self._score(self._probmap[name], feats)
+
+    def _nkeep(self, nfeats):
+        """[private] Return how many of nfeats features to keep."""
+        return int(max(self._feat_th * nfeats, self._feat_min))
+
+    def _score(self, score, feats):
+        """[private] Given a list of feature records, multiply score by
+        the probabilities of the most interesting ones.
+        """
+        # Select the "most interesting" features from the input
+        # for this category.  A feature is more interesting the
+        # further from 0.5 its membership probability lies.
+        # nlargest() selects the same features, in the same order, as
+        # a stable sort in descending order would.
+
+        feats = heapq.nlargest(self._nkeep(len(feats)), feats,
+                               key=itemgetter(0))
+
+        for k, p in feats:
+            if p == 0:
+                score *= self._epsilon
+            else:
+                score *= p
+
+        return score
+
+    def _log_score(self, score, feats):
+        """[private] As ._score(), but adds the natural logarithms of
+        the probabilities to score, computed with floats.
+        """
+        key = lambda i: feats[i][0]
+        nkeep = self._nkeep(len(feats))
+        order = heapq.nlargest(nkeep + 1, xrange(len(feats)), key=key)
+
+        # Only a run of ties straddling the cutoff needs the Decimal
+        # keys to break it the way ._score() does; that requires the
+        # full ordering.
+        if 0 < nkeep < len(order):
+            tie = feats[order[nkeep]][0]
+            if feats[order[nkeep - 1]][0] == tie:
+                order = sorted(xrange(len(feats)), key=key, reverse=True)
+                lo = nkeep - 1
+                while lo > 0 and feats[order[lo - 1]][0] == tie:
+                    lo -= 1
+                hi = nkeep + 1
+                while hi < len(order) and feats[order[hi]][0] == tie:
+                    hi += 1
+
+                def dkey(i):
+                    c, t = feats[i][2:]
+                    p = self._epsilon if t == 0 else D(c) / t
+                    return abs(p - self._uniform)
+
+                order[lo:hi] = sorted(order[lo:hi], key=dkey, reverse=True)
+
+        for i in order[:nkeep]:
+            score += feats[i][1]
+
+        return score
 
     def finish(self):
         return self._probmap
@@ -185,6 +452,129 @@ class hmm_classifier(classifier, trainer):
         return argmax(self._probmap)
 
 
+class hmm_classifier(hmm_model, classifier, trainer):
+    """Classifies using a simple Hidden Markov model, with training
+    data stored in a database.  See hmm_model for a description of the
+    scoring rules.
+    """
+    def __init__(self,
+                 db_path,
+                 feat_th=D('0.1'),
+                 feat_min=15,
+                 eps=D('0.01'),
+                 log_space=False,
+                 cache_size=classdata.default_cache_size,
+                 **options):
+        """Initializes a new HMM classifier.
+
+        db_path    -- where the database file is located.
+        feat_th    -- percent of features to keep, (0,..1]
+        feat_min   -- minimum number of features to keep.
+        eps        -- probability imputed to unrepresented features.
+        log_space  -- if true, score with floats in log-probability space.
+        cache_size -- maximum number of words cached per group, or None.
+
+        Other keyword options (read_only, wal, mmap_size, sql_cache_size,
+        timeout, check_same_thread, word_hash, change_log, shards) are
+        passed to classdata.groupdata to configure the database.
+        """
+        hmm_model.__init__(self, feat_th, feat_min, eps, log_space,
+                           cache_size)
+        classifier.__init__(self, db_path, cache_size, **options)
+        self._feature_key = self._key  # as the words are stored
+
+    def discard(self):
+        # Discarding also follows changes whose words are not known,
+        # such as those seen by .refresh(), or made by .compact().
+        super(hmm_classifier, self).discard()
+        self._clear_features()
+
+    def commit(self):
+        # Only the words written have new counts, and so new features.
+        # Document counts do not affect features, and a new group is
+        # noticed by .start().
+        written = set(w.text for w in self._dirty.itervalues())
+        super(hmm_classifier, self).commit()
+        self._forget_features(written)
+
+    def _cache_features(self):
+        # Records computed from uncommitted changes must not outlive them.
+        return not self._dirty
+
+    def _feature_table(self, words):
+        words = set(words)
+        self.prefetch(words)
+
+        table = {}
+        for group in self.all_groups():
+            feats = table[group.name] = {}
+            for w in words:
+                wrd = group[w]
+                feats[w] = self._feature(wrd.get_count(), wrd.get_total())
+        return table
+
+
+class training_session(object):
+    """A context manager that defers the commits of a trainer, and
+    writes accumulated changes in batches.  See trainer.session().
+    """
+    def __init__(self, trainer, max_docs=1000, max_bytes=None):
+        self.trainer = trainer
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.docs = 0  # documents since the last flush
+        self.bytes = 0  # bytes of word text since the last flush
+        self.flushes = 0  # number of flushes so far
+
+    def __enter__(self):
+        if self.trainer._session is not None:
+            raise ValueError("A training session is already active")
+
+        self.trainer._session = self
+        return self
+
+    def __exit__(self, etype, evalue, tb):
+        self.trainer._session = None
+        if etype is None:
+            self.flush()
+        else:
+            self.trainer.discard()
+            self.docs = self.bytes = 0
+
+        return False
+
+    def add(self, docs, nbytes):
+        """Account for docs documents and nbytes bytes of changes, and
+        flush if either limit has been reached.
+        """
+        self.docs += docs
+        self.bytes += nbytes
+        if ((self.max_docs is not None and self.docs >= self.max_docs) or
+            (self.max_bytes is not None and self.bytes >= self.max_bytes)):
+            self.flush()
+
+    def flush(self):
+        """Commit all the changes accumulated so far."""
+        self.trainer.commit()
+        self.docs = self.bytes = 0
+        self.flushes += 1
+
+
+def merge_counts(inputs):
+    """Given a sequence of inputs, each a sequence of (word, count)
+    pairs, return a tuple (delta, num) where delta is an aggregator
+    giving the sum of the counts of each word over all the inputs,
+    and num is the number of inputs.
+    """
+    delta = textparsers.aggregator()
+    num = 0
+    for input in inputs:
+        delta += input
+        num += 1
+
+    return delta, num
+
+
 def argmax(d):
     """Return the key from the given dictionary whose value is maximal
     according to comparison by the built-in cmp function.
@@ -203,6 +593,7 @@ def argmax(d):
     return max_key
 
 
-__all__ = ('classifier', 'trainer', 'hmm_classifier', 'argmax')
+__all__ = ('classifier', 'trainer', 'training_session', 'hmm_model',
+           'hmm_classifier', 'merge_counts', 'argmax')
 
 # Here there be dragons
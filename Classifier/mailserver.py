@@ -0,0 +1,160 @@
+##
+## Name:     mailserver.py
+## Purpose:  Long-running server to classify and tag e-mail messages.
+##
+## Copyright (C) 2008 Michael J. Fromberger, All Rights Reserved.
+##
+## The server listens on a Unix-domain socket.  Each connection carries
+## one or more requests, each a line giving a command and a length,
+## followed by that many bytes of raw message text:
+##
+##   TAG <length>\n<message>      -- reply with the tag for the message.
+##   FILTER <length>\n<message>   -- reply with the message, tagged.
+##
+## A successful reply is "OK <length>\n" followed by that many bytes of
+## result; a failure is "ERR <explanation>\n", after which the server
+## closes the connection.
+##
+
+import os, socket, SocketServer, threading
+from email import message_from_string
+from mailwrangler import split_mail
+from textparsers import aggregator
+
+# Header used to record the tag assigned to a message
+tag_header = 'X-MailTag'
+
+# Tag assigned when a message cannot be classified
+unknown_tag = 'unknown'
+
+# Largest message the server will accept, in bytes
+max_message = 64 << 20
+
+
+def set_tag(msg, tag):
+    """Record tag in the header of the e-mail message msg."""
+    try:
+        msg.replace_header(tag_header, tag)
+    except KeyError:
+        msg.add_header(tag_header, tag)
+
+
+class tag_handler(SocketServer.StreamRequestHandler):
+    """Handles the requests on one connection to a tag_server."""
+    def handle(self):
+        while True:
+            line = self.rfile.readline(256)
+            if not line:
+                break
+
+            try:
+                cmd, size = line.split()
+                size = int(size)
+            except ValueError:
+                self.fail('malformed request')
+                break
+            if cmd not in ('TAG', 'FILTER'):
+                self.fail('unknown command %r' % cmd)
+                break
+            if not 0 <= size <= max_message:
+                self.fail('invalid message length %d' % size)
+                break
+
+            raw = self.rfile.read(size)
+            if len(raw) < size:
+                break
+
+            try:
+                out = self.server.process(cmd, raw)
+            except Exception, e:
+                # The reply must stay on one line.
+                self.fail(' '.join(str(e).split()) or type(e).__name__)
+                break
+
+            self.wfile.write('OK %d\n' % len(out))
+            self.wfile.write(out)
+            self.wfile.flush()
+
+    def fail(self, why):
+        self.wfile.write('ERR %s\n' % why)
+
+
+class tag_server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Serves tagging requests using a single classifier, which stays
+    open (and keeps its caches) across requests.  Each connection is
+    handled in its own thread; messages are parsed concurrently, but
+    access to the classifier is serialized.  If the classifier reads
+    from a database, it must permit use from multiple threads (see
+    the check_same_thread option of classdata.groupdata).
+
+    Before each classification, the classifier's caches are discarded
+    if its database has been changed by another connection, so that
+    training is visible to the server without a restart.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, path, cls):
+        """Initializes a server listening at the socket path, using the
+        classifier cls.  A stale socket file left at path is removed;
+        socket.error is raised if another server is listening there.
+        """
+        self.classifier = cls
+        self.lock = threading.Lock()
+        self.requests = 0  # number of requests served
+        remove_stale_socket(path)
+        SocketServer.UnixStreamServer.__init__(self, path, tag_handler)
+
+    def tag(self, msg):
+        """Classify the e-mail message msg, and return its tag."""
+        txt = aggregator(split_mail(msg))
+        with self.lock:
+            self.requests += 1
+            self.classifier.refresh()
+            try:
+                self.classifier.classify(txt)
+                return self.classifier.result_group()
+            except TypeError:
+                return unknown_tag
+
+    def process(self, cmd, raw):
+        """Carry out the command cmd on the raw message text, and return
+        the result as a string.
+        """
+        msg = message_from_string(raw)
+        tag = self.tag(msg)
+        if cmd == 'TAG':
+            return tag
+
+        set_tag(msg, tag)
+        return str(msg)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+def remove_stale_socket(path):
+    """Remove the socket file at path if no server is listening there.
+    Raises socket.error if a server is listening.
+    """
+    if not os.path.exists(path):
+        return
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except socket.error:
+        os.unlink(path)
+    else:
+        raise socket.error("A server is already listening at %s" % path)
+    finally:
+        probe.close()
+
+
+__all__ = ('tag_server', 'set_tag')
+
+# Here there be dragons
@@ -5,11 +5,12 @@
 ## Copyright (C) 2008 Michael J. Fromberger, All Rights Reserved.
 ##
 
-import base64, htmlentitydefs, itertools, os, quopri, re, sgmllib, urlparse
+import base64, codecs, htmlentitydefs, itertools, mmap, os, quopri, re
+import sgmllib, stat, urlparse
 from textparsers import *
 from email.Utils import getaddresses
-from email import message_from_file
-from mailbox import PortableUnixMailbox as MBox
+from email import message_from_string
+from multiprocessing import Pool
 from tempfile import TemporaryFile
 
 # -- English stopword set
@@ -25,6 +26,24 @@ english_stopwords = set(
      'us', 'very', 'was', 'we', 'were', 'what', 'when', 'where', 'who', 'why',
      'with', 'you', 'your'))
 
+# Number of characters of HTML parsed at a time by strip_html_chunks()
+html_chunk_size = 16384
+
+# Number of bytes read at a time from a mailbox that cannot be mapped
+mbox_block_size = 1 << 20
+
+# Mailbox data shared with read_mailbox() worker processes
+_worker_data = None
+
+# Default limits on the work split_mail() does for one message
+max_part_bytes = 1 << 19
+max_message_bytes = 1 << 21
+max_parts = 32
+max_tokens = 1 << 16
+
+# Characters ignored in base64 text
+b64_junk_re = re.compile(r'[^A-Za-z0-9+/=]')
+
 
 class html_stripper(sgmllib.SGMLParser):
     """A minimalist parser for HTML that extracts the features which
@@ -48,18 +67,18 @@ class html_stripper(sgmllib.SGMLParser):
     def __init__(self):
         sgmllib.SGMLParser.__init__(self)
 
-        self.output = ''  # collects result
+        self.output = []  # collects pieces of the result
         self.level = 0  # > 0 means to ignore content
 
     def reset(self):
         sgmllib.SGMLParser.reset(self)
 
-        self.output = ''
+        self.output = []
         self.level = 0
 
     def handle_data(self, data):
         if self.level == 0 and data:
-            self.output += data
+            self.output.append(data)
 
     def handle_charref(self, name):
         if self.level > 0:
@@ -71,36 +90,36 @@ class html_stripper(sgmllib.SGMLParser):
             self.handle_entityref(new)
         else:
             try:
-                self.output += unichr(cval)
+                self.output.append(unichr(cval))
             except ValueError:
-                self.output += "&#%s;" % name
+                self.output.append("&#%s;" % name)
 
     def handle_entityref(self, name):
         if self.level > 0:
             return
 
         if name in ('ldquo', 'rdquo', 'quot', 'laquo', 'raquo'):
-            self.output += '"'
+            self.output.append('"')
         elif name in ('lsquo', 'rsquo', 'lsaquo', 'rsaquo'):
-            self.output += "'"
+            self.output.append("'")
         elif name in ('nbsp', ):
-            self.output += ' '
+            self.output.append(' ')
         elif name in self.entitydefs:
-            self.output += self.entitydefs[name]
+            self.output.append(self.entitydefs[name])
         else:
-            self.output += '&%s;' % name
+            self.output.append('&%s;' % name)
 
     def unknown_starttag(self, tag, attrs):
         if tag in self.machine_tags:
             self.level += 1
 
-        self.output += ' '
+        self.output.append(' ')
 
     def unknown_endtag(self, tag):
         if tag in self.machine_tags and self.level > 0:
             self.level -= 1
 
-        self.output += ' '
+        self.output.append(' ')
 
     def parse_declaration(self, i):
         # If the declaration (usually DOCTYPE) is unclosed, this
@@ -119,7 +138,15 @@ class html_stripper(sgmllib.SGMLParser):
                 raise
 
     def result(self):
-        return self.output
+        """Return all the text produced so far."""
+        self.output = [''.join(self.output)]
+        return self.output[0]
+
+    def take(self):
+        """Return the text produced since the last call, and discard it."""
+        out = ''.join(self.output)
+        self.output = []
+        return out
 
 
 def strip_html(text):
@@ -134,18 +161,203 @@ def strip_html(text):
     return par.result()
 
 
+def strip_html_chunks(text, size=html_chunk_size):
+    """Strip HTML tags from the specified text as strip_html() does,
+    but generate the result in pieces as the text is parsed, about size
+    characters at a time.  Joined, the pieces equal strip_html(text).
+    """
+    par = html_stripper()
+    pos = 0
+    while pos < len(text):
+        # The parser can finish an entity early if the text it has so
+        # far ends within it, so pieces of text end just after a ">".
+        # Text the parser could not finish is parsed again with the
+        # next piece; growing the piece keeps this from going quadratic
+        # when a tag or comment is very long.
+        step = max(size, len(par.rawdata))
+        end = text.rfind('>', pos, pos + step) + 1
+        if end <= pos:
+            end = text.find('>', pos + step) + 1 or len(text)
+        par.feed(text[pos:end])
+        pos = end
+
+        out = par.take()
+        if out:
+            yield out
+
+    par.close()
+    out = par.take()
+    if out:
+        yield out
+
+
 def remove_stopwords(input):
     """A text filter to remove English stopwords."""
-    return select(lambda w: w not in english_stopwords)(input)
+    for w in input:
+        if w not in english_stopwords:
+            yield w
+
+
+def mbox_ranges(data):
+    """Generate (start, end) pairs giving the positions of the messages
+    in data, the text of a Unix mailbox as a string or mmap.  As with
+    mailbox.PortableUnixMailbox, each line beginning with "From " starts
+    a message, and is the first line of its text, data[start:end].
+    """
+    last = None
+    for pos in _from_lines(data):
+        if last is not None:
+            yield (last, pos)
+        last = pos
+
+    if last is not None:
+        yield (last, len(data))
+
+
+def split_mailbox(fp, size=mbox_block_size):
+    """Given an open file handle to a Unix mailbox, generate the raw text
+    of each message found in that mailbox, as divided by mbox_ranges().
+    A regular file is mapped into memory and scanned in place; other
+    input, such as a pipe, is read size bytes at a time.  Neither way
+    copies the input to a temporary file, nor reads it line by line.
+    """
+    data = _map_mailbox(fp)
+    if data is not None:
+        try:
+            for start, end in mbox_ranges(data):
+                yield data[start:end]
+        finally:
+            data.close()
+        return
+
+    hold = None  # pieces of the message being read, once one is found
+    while True:
+        data = fp.read(size)
+        if not data:
+            break
+        if not data.endswith('\n'):
+            data += fp.readline()  # so no line spans two blocks
 
+        last = 0
+        for pos in _from_lines(data):
+            if hold is not None:
+                hold.append(data[last:pos])
+                yield ''.join(hold)
+            hold = []
+            last = pos
 
-def read_mailbox(fp):
+        if hold is not None:
+            hold.append(data[last:])
+
+    if hold:
+        yield ''.join(hold)
+
+
+def _from_lines(data):
+    """[private] Generate the positions of lines in data that begin
+    with "From ".
+    """
+    if data[:5] == 'From ':
+        yield 0
+
+    pos = data.find('\nFrom ')
+    while pos >= 0:
+        yield pos + 1
+        pos = data.find('\nFrom ', pos + 1)
+
+
+def _map_mailbox(fp):
+    """[private] Map the contents of fp into memory, and return the
+    mmap object; returns None if fp is not a non-empty regular file.
+    """
+    try:
+        fd = fp.fileno()
+        info = os.fstat(fd)
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+    if not stat.S_ISREG(info.st_mode) or info.st_size == 0:
+        return None
+
+    try:
+        return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError):
+        return None
+
+
+def read_mailbox(fp, jobs=1, batch=256):
     """Given an open file handle to a Unix mailbox, return an iterator
     over all the messages found in that mailbox.  Each element returned
-    by the iterator is an aggregated word sequence.
+    by the iterator is an aggregated word sequence.  The mailbox is
+    read by split_mailbox(), so fp need not be seekable.
+
+    If jobs > 1, messages are parsed and aggregated by a pool of that
+    many worker processes, in batches of the given size; the results
+    are still delivered in mailbox order.
+    """
+    if jobs > 1:
+        return _read_mailbox_parallel(fp, jobs, batch)
+
+    return (_split_raw_message(text) for text in split_mailbox(fp))
+
+
+def _read_mailbox_parallel(fp, jobs, batch):
+    """[private] Implements read_mailbox() for jobs > 1.  The workers
+    do the parsing; if the mailbox can be mapped into memory, they
+    inherit the mapping and are sent only the range of each message,
+    otherwise the parent reads the raw text of each message and sends
+    that.  One batch is parsed while the caller consumes the results of
+    the last.
+    """
+    data = _map_mailbox(fp)
+    if data is not None:
+        raw = mbox_ranges(data)
+        pool = Pool(jobs, _init_worker, (data, ))
+        split = _split_message_range
+    else:
+        raw = split_mailbox(fp)
+        pool = Pool(jobs)
+        split = _split_raw_message
+    try:
+        last = None
+        while True:
+            msgs = list(itertools.islice(raw, batch))
+            if msgs:
+                work = pool.map_async(split, msgs,
+                                      max(1, len(msgs) // (4 * jobs)))
+            else:
+                work = None
+
+            if last is not None:
+                for res in last.get():
+                    yield res
+            if work is None:
+                break
+            last = work
+    finally:
+        pool.terminate()
+        if data is not None:
+            data.close()
+
+
+def _init_worker(data):
+    """[private] Initializes a read_mailbox() worker process; data is
+    the mailbox, mapped into memory by the parent.
     """
-    return (aggregator(split_mail(m, True))
-            for m in MBox(fp, message_from_file))
+    global _worker_data
+    _worker_data = data
+
+
+def _split_message_range(pos):
+    """[private] Worker for read_mailbox(); aggregates the message whose
+    range in the mailbox is given by pos.
+    """
+    start, end = pos
+    return _split_raw_message(_worker_data[start:end])
+
+
+def _split_raw_message(text):
+    """[private] Worker for read_mailbox(); aggregates raw message text."""
+    return aggregator(split_mail(message_from_string(text), True))
 
 
 def split_text(text):
@@ -156,19 +368,57 @@ def split_text(text):
 
 def split_html(text):
     """Return a word sequence extracted from the given HTML data."""
-    proc = compose(strip_html, word_split, lowercase, remove_stopwords)
-    return proc(text)
+    proc = compose(word_split, lowercase, remove_stopwords)
+    return itertools.chain.from_iterable(
+        itertools.imap(proc, text_segments(strip_html_chunks(text))))
 
 
-def split_mail(msg, fail_on_empty=False):
+class mail_budget(object):
+    """Limits on the work split_mail() does for one message, so that a
+    huge attachment or HTML body cannot stall it.  Any limit may be
+    None, meaning there is no limit.
+
+    part_bytes    -- bytes decoded from any one text part.
+    message_bytes -- bytes decoded from all the text parts together.
+    parts         -- number of text parts read.
+    tokens        -- number of words produced, counting the headers.
+
+    Text past a byte limit is not decoded at all.  Words are produced
+    as they are requested, so no text is split past the token limit.
+    """
+    def __init__(self,
+                 part_bytes=max_part_bytes,
+                 message_bytes=max_message_bytes,
+                 parts=max_parts,
+                 tokens=max_tokens):
+        self.part_bytes = part_bytes
+        self.message_bytes = message_bytes
+        self.parts = parts
+        self.tokens = tokens
+
+    def __repr__(self):
+        return '#<%s part_bytes=%r message_bytes=%r parts=%r tokens=%r>' % (
+            type(self).__name__, self.part_bytes, self.message_bytes,
+            self.parts, self.tokens)
+
+
+# Budget used by split_mail() when none is given
+default_budget = mail_budget()
+
+
+def split_mail(msg, fail_on_empty=False, budget=None):
     """Deconstruct an email.Message object into a sequence of words;
-    returns an iterator for this sequence.
+    returns an iterator for this sequence.  The work done is limited
+    by budget, a mail_budget; if it is None, default_budget is used.
 
     If fail_on_empty is true, then ValueError is raised if no
     parseable message parts could be found.  This function can only
     handle text parts, and does not attempt to extract meaningful data
     from other content types.
     """
+    if budget is None:
+        budget = default_budget
+
     coll = set()
     results = [coll]
 
@@ -185,71 +435,131 @@ def split_mail(msg, fail_on_empty=False):
                    add_prefix('subj', ':'))
     results.append(proc(msg.get('subject', '')))
 
-    found = 0
+    parts = []
     for part in msg.walk():
         if part.get_content_maintype() != 'text':
             continue  # skip non-text parts
 
         enc = part.get('content-transfer-encoding')
-        if enc is None:
-            text = part.get_payload()
-        elif enc.lower() == 'quoted-printable':
-            text = quopri.decodestring(part.get_payload())
-        elif enc.lower() == 'base64':
-            text = base64.decodestring(part.get_payload())
-        elif enc.lower() in (None, '7bit', '8bit', 'binary'):
-            text = part.get_payload()
-        else:
+        if enc is not None and enc.lower() not in (
+                'quoted-printable', 'base64', '7bit', '8bit', 'binary'):
             continue  # unknown encoding method
+        if part.get_content_subtype() not in ('html', 'plain', 'enriched'):
+            continue  # unknown text type
 
-        # Since the content may be encoded with some weird character
-        # set, we'll try to get it back to Unicode so the XML parser
-        # doesn't choke too hard.
+        parts.append(part)
 
-        for cs in part.get_charsets():
-            if not cs:
-                continue
+    if not parts and fail_on_empty:
+        raise ValueError("No parseable content found")
 
-            try:
-                text = text.decode(cs)
+    if budget.parts is not None:
+        del parts[budget.parts:]
+    results.append(
+        itertools.chain.from_iterable(_split_parts(parts, budget)))
+
+    words = itertools.chain(*results)
+    if budget.tokens is not None:
+        words = itertools.islice(words, budget.tokens)
+    return words
+
+
+def _split_parts(parts, budget):
+    """[private] Generate a word sequence for each of the given text
+    parts of a message, decoding each part only when its words are
+    needed, and only as much of it as budget allows.
+    """
+    left = budget.message_bytes
+    for part in parts:
+        limit = budget.part_bytes
+        if left is not None:
+            if left <= 0:
                 break
-            except UnicodeDecodeError:
-                continue
-        else:
-            # If we can't decode it some other way, try ISO 8859-1,
-            # which subsubmes US ASCII anyway.
-            text = text.decode('latin1')
+            limit = left if limit is None else min(limit, left)
+
+        text, size = _decode_part(part, limit)
+        if left is not None:
+            left -= size
 
         proc = compose(unfold_entities, word_split, lowercase,
                        remove_stopwords, crush_urls, limit_length(100))
-        sub = part.get_content_subtype()
-        if sub == 'html':
-            proc = compose(strip_html, proc)
-        elif sub not in ('plain', 'enriched'):
-            continue  # unknown text type
+        if part.get_content_subtype() == 'html':
+            # Words are split from the stripped text as it is produced.
+            segs = text_segments(strip_html_chunks(text))
+            yield itertools.chain.from_iterable(itertools.imap(proc, segs))
+        else:
+            yield proc(text)
 
-        results.append(proc(text))
-        found += 1
 
-    if found == 0 and fail_on_empty:
-        raise ValueError("No parseable content found")
+def _decode_part(part, limit=None):
+    """[private] Decode the payload of a text part of a message, keeping
+    no more than limit bytes of it if limit is not None.  Returns a pair
+    of the text, as Unicode, and the number of bytes kept.
+    """
+    enc = (part.get('content-transfer-encoding') or '').lower()
+    text = part.get_payload()
+    cut = False  # was some of the text left out?
+
+    # Decode only as much of the payload as may be needed.  Each byte of
+    # quoted-printable text takes at most 3 characters to encode; base64
+    # takes 4 characters, less line breaks, for each 3 bytes.
+    if enc == 'quoted-printable':
+        if limit is not None and len(text) > 3 * limit:
+            text = text[:text.rfind('\n', 0, 3 * limit) + 1 or 3 * limit]
+            cut = True
+        text = quopri.decodestring(text)
+    elif enc == 'base64':
+        need = (limit + 2) // 3 * 4 if limit is not None else None
+        if need is not None and len(text) > need + need // 38 + 80:
+            text = b64_junk_re.sub('', text[:need + need // 38 + 80])
+            text = text[:len(text) - len(text) % 4]
+            cut = True
+        text = base64.decodestring(text)
+
+    if limit is not None and len(text) > limit:
+        text = text[:limit]
+        cut = True
+    size = len(text)
+
+    # Since the content may be encoded with some weird character
+    # set, we'll try to get it back to Unicode so the XML parser
+    # doesn't choke too hard.  A character cut off at the end of a
+    # truncated part is dropped.
+
+    for cs in part.get_charsets():
+        if not cs:
+            continue
+
+        try:
+            if cut:
+                text = codecs.getincrementaldecoder(cs)().decode(text)
+            else:
+                text = text.decode(cs)
+            break
+        except UnicodeDecodeError:
+            continue
+    else:
+        # If we can't decode it some other way, try ISO 8859-1,
+        # which subsubmes US ASCII anyway.
+        text = text.decode('latin1')
 
-    return itertools.chain(*results)
+    return text, size
 
 
 def crush_urls(input):
     """A sequence filter to flatten URL's by dropping query and
     fragment components.
     """
-    def crush(elt):
-        if elt.startswith('http:'):
-            u = list(urlparse.urlparse(elt, allow_fragments=False))
-            u[4] = ''
-            return urlparse.urlunparse(u)
-        else:
-            return elt
+    return transform(_crush_url)(input)
+
 
-    return transform(crush)(input)
+def _crush_url(elt):
+    """[private] Worker for crush_urls(); flattens a single word."""
+    if elt.startswith('http:'):
+        u = list(urlparse.urlparse(elt, allow_fragments=False))
+        u[4] = ''
+        return urlparse.urlunparse(u)
+    else:
+        return elt
 
 
 def make_seekable(fp):
@@ -280,7 +590,9 @@ def make_seekable(fp):
     return out
 
 
-__all__ = ('strip_html', 'remove_stopwords', 'read_mailbox', 'split_text',
-           'split_html', 'split_mail', 'make_seekable')
+__all__ = ('strip_html', 'strip_html_chunks', 'remove_stopwords',
+           'mbox_ranges', 'split_mailbox', 'read_mailbox', 'split_text',
+           'split_html', 'mail_budget', 'default_budget', 'split_mail',
+           'make_seekable')
 
 # Here there be dragons
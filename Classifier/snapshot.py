@@ -0,0 +1,350 @@
+##
+## Name:     snapshot.py
+## Purpose:  Frozen in-memory copy of classifier training data.
+##
+## Copyright (C) 2008 Michael J. Fromberger, All Rights Reserved.
+##
+
+import cPickle as pickle
+from array import array
+from classdata import connect_read_only, hash_word, shard_paths
+from classifier import hmm_model
+from decimal import Decimal as D
+
+# Version tag for saved snapshot files.  Version 1 files, which predate
+# word hashing, are still accepted.
+snapshot_version = 2
+
+
+class model_snapshot(object):
+    """A frozen, array-backed copy of the data in a classification
+    database.  Each word is assigned a dense index; for each group
+    there is an array of word counts at those indices, and there is a
+    single array of word totals.  Once built, a snapshot needs no
+    access to the database.  If the database hashes words, so does the
+    snapshot, and its words are the hash keys.
+    """
+    def __init__(self,
+                 names,
+                 docs,
+                 words,
+                 counts,
+                 totals,
+                 doc_count=0,
+                 word_hash=None,
+                 sequence=0):
+        """Initialize a snapshot from its parts.
+
+        names     -- list of group names.
+        docs      -- list of document counts, parallel to names.
+        words     -- list of words; the position of a word is its index.
+        counts    -- list of arrays of word counts, parallel to names.
+        totals    -- array of word totals, parallel to words.
+        doc_count -- overall document count for the training set.
+        word_hash -- word hashing mode, as for classdata.groupdata.
+        sequence  -- sequence number of the last change record included
+                     (see the changelog module).
+        """
+        self.names = list(names)
+        self.docs = list(docs)
+        self.words = list(words)
+        self.index = dict((w, i) for i, w in enumerate(self.words))
+        self.counts = counts
+        self.totals = totals
+        self.doc_count = doc_count
+        self.word_hash = word_hash
+        self.sequence = sequence
+
+    @classmethod
+    def from_database(cls, db_path):
+        """Compile a snapshot from the database at db_path.  Raises
+        sqlite3.Error if it cannot be read, or does not exist.
+        """
+        db = connect_read_only(db_path)
+        try:
+            groups = list(
+                db.execute('select idNum, name, count from Classes '
+                           'order by idNum'))
+            settings = dict(db.execute('select name, value from Settings'))
+            gpos = dict((id, i) for i, (id, n, c) in enumerate(groups))
+
+            # The words of a sharded database are read from each shard
+            # in turn.
+            if settings.get('shards') is None:
+                stores = [db]
+            else:
+                stores = list(
+                    connect_read_only(p)
+                    for p in shard_paths(db_path, int(settings['shards'])))
+
+            rows = []
+            counts = list(array('l') for g in groups)
+            for store in stores:
+                base = len(rows)
+                rows.extend(
+                    store.execute('select idNum, word, total from Words '
+                                  'order by idNum'))
+                pos = dict((rows[i][0], i) for i in xrange(base, len(rows)))
+                for arr in counts:
+                    arr.extend(array('l', [0]) * (len(rows) - base))
+
+                for wid, gid, count in store.execute(
+                        'select wordID, classID, count from Data'):
+                    if wid in pos and gid in gpos:
+                        counts[gpos[gid]][pos[wid]] = count
+                if store is not db:
+                    store.close()
+        finally:
+            db.close()
+
+        doc_count = int(settings.get('document_count', 0))
+        word_hash = settings.get('word_hash')
+        if word_hash is not None:
+            word_hash = int(word_hash)
+
+        return cls((n for id, n, c in groups), (c for id, n, c in groups),
+                   (w for id, w, t in rows), counts,
+                   array('l', (t for id, w, t in rows)), doc_count,
+                   word_hash, int(settings.get('log_sequence', 0)))
+
+    @classmethod
+    def load(cls, path):
+        """Load a snapshot previously written by .save().  Raises
+        TypeError if the file is not a snapshot this version can read,
+        including one that is truncated or corrupt.
+        """
+        with open(path, 'rb') as fp:
+            try:
+                data = pickle.load(fp)
+            except (pickle.UnpicklingError, EOFError, AttributeError,
+                    ImportError, IndexError, KeyError, ValueError), e:
+                raise TypeError("Corrupt snapshot: %s" %
+                                (str(e) or type(e).__name__))
+
+        if not isinstance(data, dict):
+            raise TypeError("Corrupt snapshot: not a snapshot")
+        if data.get('version') not in (1, snapshot_version):
+            raise TypeError("Incompatible snapshot")
+
+        def unpack(s):
+            a = array('l')
+            a.fromstring(s)
+            return a
+
+        try:
+            return cls(data['names'], data['docs'], data['words'],
+                       list(unpack(s) for s in data['counts']),
+                       unpack(data['totals']), data['doc_count'],
+                       data.get('word_hash'), data.get('sequence', 0))
+        except (KeyError, ValueError), e:
+            raise TypeError("Corrupt snapshot: missing or bad %s" % e)
+
+    def save(self, path):
+        """Write the snapshot to the file at path."""
+        data = {
+            'version': snapshot_version,
+            'names': self.names,
+            'docs': self.docs,
+            'words': self.words,
+            'counts': list(a.tostring() for a in self.counts),
+            'totals': self.totals.tostring(),
+            'doc_count': self.doc_count,
+            'word_hash': self.word_hash,
+            'sequence': self.sequence,
+        }
+        with open(path, 'wb') as fp:
+            pickle.dump(data, fp, pickle.HIGHEST_PROTOCOL)
+
+    def log_sequence(self):
+        """Return the sequence number of the last change record included
+        in the snapshot, or 0 if there is none.
+        """
+        return self.sequence
+
+    def apply_changes(self, records):
+        """Apply a sequence of (sequence number, change record) pairs
+        read from a change log (see the changelog module), and return
+        the number of records applied.  The result is the snapshot of
+        the database with the changes applied.
+
+        The records must continue from .log_sequence() without gaps,
+        and must have been logged by a database that hashes words the
+        same way as this snapshot.  A snapshot does not record when
+        words were trained, so it cannot follow a compaction by age or
+        word count; it must then be exported again.  In any of these
+        cases ValueError is raised and nothing is applied.
+        """
+        records = list(records)
+        last = self.sequence
+        for seq, rec in records:
+            if seq != last + 1:
+                raise ValueError("Change record %d does not follow %d" %
+                                 (seq, last))
+            if rec.get('hash') != self.word_hash:
+                raise ValueError("Change record %d word hashing mode is %r" %
+                                 (seq, rec.get('hash')))
+            limits = rec.get('compact', {})
+            if (limits.get('max_age') is not None or
+                    limits.get('max_words') is not None):
+                raise ValueError("Change record %d cannot be applied to a "
+                                 "snapshot" % seq)
+            last = seq
+
+        for seq, rec in records:
+            self._apply_record(rec)
+        self.sequence = last
+        return len(records)
+
+    def _apply_record(self, rec):
+        """[private] Apply the changes in a change record."""
+        for key, op, val in rec.get('settings', ()):
+            if key == 'document_count':
+                if op == 'add':
+                    self.doc_count = max(self.doc_count + val, 0)
+                else:
+                    self.doc_count = int(val or 0)
+
+        gpos = dict((n, i) for i, n in enumerate(self.names))
+
+        def group(name):
+            pos = gpos.get(name)
+            if pos is None:
+                pos = gpos[name] = len(self.names)
+                self.names.append(name)
+                self.docs.append(0)
+                self.counts.append(array('l', [0]) * len(self.words))
+            return pos
+
+        for name in rec.get('groups', ()):
+            group(name)
+        for name, (op, val) in rec.get('docs', {}).iteritems():
+            pos = group(name)
+            if op == 'add':
+                val += self.docs[pos]
+            self.docs[pos] = max(val, 0)
+
+        # Counts are limited below by zero, as in the database; a word
+        # whose counts are all zero is the same as a word not present.
+        totals = self.totals
+        for op in ('set', 'add'):
+            for name, pairs in rec.get(op, {}).iteritems():
+                counts = self.counts[group(name)]
+                for word, val in pairs:
+                    pos = self.index.get(word)
+                    if pos is None:
+                        pos = self.index[word] = len(self.words)
+                        self.words.append(word)
+                        totals.append(0)
+                        for arr in self.counts:
+                            arr.append(0)
+                    old = counts[pos]
+                    if op == 'add':
+                        val += old
+                    counts[pos] = max(val, 0)
+                    totals[pos] += counts[pos] - old
+
+        min_total = rec.get('compact', {}).get('min_total')
+        if min_total is not None:
+            for pos, tot in enumerate(totals):
+                if tot < min_total:
+                    totals[pos] = 0
+                    for arr in self.counts:
+                        arr[pos] = 0
+
+    def __len__(self):
+        """Returns the number of distinct words in the snapshot."""
+        return len(self.words)
+
+
+class snapshot_classifier(hmm_model):
+    """Classifies using a simple Hidden Markov model, with training
+    data taken from a model_snapshot.  Classification uses only
+    in-memory lookups; the database is never consulted.  Results are
+    the same as those of an hmm_classifier with the same parameters
+    reading the database the snapshot was compiled from.
+    """
+    def __init__(self,
+                 snap,
+                 feat_th=D('0.1'),
+                 feat_min=15,
+                 eps=D('0.01'),
+                 log_space=False):
+        """Initializes a new snapshot classifier.
+
+        snap       -- a model_snapshot, or the path of a saved one.
+        feat_th    -- percent of features to keep, (0,..1]
+        feat_min   -- minimum number of features to keep.
+        eps        -- probability imputed to unrepresented features.
+        log_space  -- if true, score with floats in log-probability space.
+        """
+        super(snapshot_classifier, self).__init__(feat_th, feat_min, eps,
+                                                  log_space)
+        if not isinstance(snap, model_snapshot):
+            snap = model_snapshot.load(snap)
+        self._snap = snap
+        self._sequence = snap.sequence  # when features were cleared
+
+    def snapshot(self):
+        """Return the snapshot this classifier reads from."""
+        return self._snap
+
+    def classify(self, input):
+        """Given an input sequence of (word, count) pairs, generate an
+        output dictionary mapping group names to probability estimates.
+        """
+        self.start()
+        self.update(input)
+        return self.finish()
+
+    def _feature_table(self, words):
+        snap = self._snap
+        if snap.word_hash is None:
+            pos = list((w, snap.index.get(w)) for w in set(words))
+        else:
+            pos = list((w, snap.index.get(hash_word(w, snap.word_hash)))
+                       for w in set(words))
+        tots = list(0 if i is None else snap.totals[i] for w, i in pos)
+
+        table = {}
+        for name, counts in zip(snap.names, snap.counts):
+            table[name] = dict(
+                (w, self._feature(0 if i is None else counts[i], t))
+                for (w, i), t in zip(pos, tots))
+
+        return table
+
+    def group_names(self):
+        """Return an iterator over the names of the groups defined."""
+        return iter(self._snap.names)
+
+    def refresh(self):
+        """Discard the cached features if changes have been applied to
+        the snapshot since they were discarded.  Returns True if the
+        features were discarded.
+        """
+        if self._snap.sequence == self._sequence:
+            return False
+
+        self._clear_features()
+        self._sequence = self._snap.sequence
+        return True
+
+    def close(self):
+        pass
+
+    def __len__(self):
+        return len(self._snap.names)
+
+
+def export_snapshot(db_path, out_path):
+    """Compile the database at db_path into a snapshot, and save it to
+    the file at out_path.  Returns the snapshot.
+    """
+    snap = model_snapshot.from_database(db_path)
+    snap.save(out_path)
+    return snap
+
+
+__all__ = ('model_snapshot', 'snapshot_classifier', 'export_snapshot')
+
+# Here there be dragons
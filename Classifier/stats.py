@@ -0,0 +1,460 @@
+##
+## Name:     stats.py
+## Purpose:  Optional instrumentation of the classification engine.
+##
+## Copyright (C) 2008 Michael J. Fromberger, All Rights Reserved.
+##
+## Nothing is measured until enable() is called.  It replaces selected
+## methods and functions of the classdata, classifier, snapshot and
+## mailwrangler modules with wrappers that record what they do, and
+## disable() puts the originals back; so while statistics are off, the
+## code that runs is exactly the uninstrumented code.
+##
+## The dictionary returned by report() has these entries:
+##
+##   operations -- for each database operation (get_word, get_stored,
+##                 prefetch, commit, ...), and for classify and train,
+##                 the number of calls, wall time in seconds, and SQL
+##                 statements issued.  A statement is charged to the
+##                 innermost operation running in its thread when it is
+##                 issued, or to "other" if there is none; statements
+##                 issued for a sharded database by its worker threads
+##                 are charged to "other".
+##   commit     -- number of commits, word and group rows written, and
+##                 rows written per commit.
+##   caches     -- sizes, hits, misses and hit rates of the word, word
+##                 total and feature caches in use.
+##   split_mail -- messages and parts split, bytes decoded, and the wall
+##                 time spent decoding, stripping HTML and tokenizing.
+##   classify   -- calls of and wall time in each classification phase
+##                 (start, update and finish).
+##   timers     -- intervals recorded by callers with timed().
+##
+## Statements are counted only on databases opened while statistics are
+## enabled; other figures cover all objects in use.
+##
+
+import contextlib, threading, time, weakref
+
+
+class recorder(object):
+    """Accumulates named counters and timers.  A recorder may be shared
+    by several threads, such as those that read and write the shards of
+    a database.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Discard everything recorded so far."""
+        with self._lock:
+            self.counts = {}
+            self.timers = {}  # name -> [calls, seconds]
+
+    def copy(self):
+        """Return a new recorder holding what this one has recorded."""
+        res = recorder()
+        with self._lock:
+            res.counts = dict(self.counts)
+            res.timers = dict((k, list(v)) for k, v in self.timers.iteritems())
+        return res
+
+    def count(self, name, num=1):
+        """Add num to the counter with the given name."""
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + num
+
+    def add_time(self, name, seconds, calls=1):
+        """Charge calls and seconds to the timer with the given name."""
+        with self._lock:
+            try:
+                tmr = self.timers[name]
+            except KeyError:
+                tmr = self.timers[name] = [0, 0.0]
+            tmr[0] += calls
+            tmr[1] += seconds
+
+    def get_count(self, name):
+        return self.counts.get(name, 0)
+
+    def get_timer(self, name):
+        """Return the (calls, seconds) of the named timer."""
+        return tuple(self.timers.get(name, (0, 0.0)))
+
+
+# The recorder that statistics are written to
+current = recorder()
+
+_enabled = False
+_saved = []  # (owner, name, original) for each wrapper installed
+_local = threading.local()  # .ops is the stack of running operations
+_objects = weakref.WeakKeyDictionary()  # objects whose caches to report
+
+
+def enable():
+    """Start recording statistics.  Has no effect if already enabled."""
+    global _enabled
+
+    if _enabled:
+        return
+    for owner, name, wrap in _patches():
+        orig = owner.__dict__[name]
+        _saved.append((owner, name, orig))
+        setattr(owner, name, wrap(orig))
+    _enabled = True
+
+
+def disable():
+    """Stop recording statistics; what was recorded is kept."""
+    global _enabled
+
+    while _saved:
+        owner, name, orig = _saved.pop()
+        setattr(owner, name, orig)
+    _enabled = False
+
+
+def is_enabled():
+    """Return True if statistics are being recorded."""
+    return _enabled
+
+
+def reset():
+    """Discard the statistics recorded so far."""
+    current.reset()
+
+
+@contextlib.contextmanager
+def timed(name):
+    """A context manager that records the wall time of its body in the
+    timer with the given name, if statistics are enabled.
+    """
+    if not _enabled:
+        yield
+        return
+
+    start = time.time()
+    try:
+        yield
+    finally:
+        current.add_time('timer.' + name, time.time() - start)
+
+
+def report():
+    """Return a dictionary of the statistics recorded since the last
+    reset; see the module comments for its contents.
+    """
+    rec = current.copy()
+
+    ops = {}
+    for name, (calls, secs) in rec.timers.iteritems():
+        if name.startswith('op.'):
+            ops[name[3:]] = dict(calls=calls, seconds=secs, sql=0)
+    for name, num in rec.counts.iteritems():
+        if name.startswith('sql.'):
+            ops.setdefault(name[4:], dict(calls=0, seconds=0.0,
+                                          sql=0))['sql'] = num
+
+    commits = rec.get_timer('op.commit')[0]
+    rows = rec.get_count('rows.words') + rec.get_count('rows.groups')
+    commit = dict(calls=commits,
+                  word_rows=rec.get_count('rows.words'),
+                  group_rows=rec.get_count('rows.groups'),
+                  rows_per_commit=rows / float(commits) if commits else None)
+
+    caches = {}
+    for obj in list(_objects.keys()):
+        found = []
+        if hasattr(obj, 'cache_stats'):
+            found.extend(obj.cache_stats().iteritems())
+        if getattr(obj, '_features', None) is not None:
+            found.append(('features', obj._features.stats()))
+        for kind, val in found:
+            tot = caches.setdefault(kind, dict(size=0, hits=0, misses=0,
+                                               evictions=0))
+            for key in tot:
+                tot[key] += val.get(key) or 0
+    for tot in caches.itervalues():
+        looks = tot['hits'] + tot['misses']
+        tot['hit_rate'] = tot['hits'] / float(looks) if looks else None
+
+    split = dict(messages=rec.get_count('split.messages'),
+                 parts=rec.get_count('split.parts'),
+                 decoded_bytes=rec.get_count('split.bytes'))
+    total = rec.get_timer('split.total')[1]
+    for stage in ('decode', 'strip'):
+        secs = rec.get_timer('split.' + stage)[1]
+        split[stage + '_seconds'] = secs
+    split['tokenize_seconds'] = max(
+        0.0, total - split['decode_seconds'] - split['strip_seconds'])
+    split['seconds'] = total
+
+    classify = {}
+    for phase in ('start', 'update', 'finish'):
+        calls, secs = rec.get_timer('phase.' + phase)
+        classify[phase] = dict(calls=calls, seconds=secs)
+
+    timers = dict((name[6:], dict(calls=calls, seconds=secs))
+                  for name, (calls, secs) in rec.timers.iteritems()
+                  if name.startswith('timer.'))
+
+    return dict(operations=ops,
+                commit=commit,
+                caches=caches,
+                split_mail=split,
+                classify=classify,
+                timers=timers)
+
+
+def format_report(rep=None):
+    """Format a report as returned by report() as lines of text, one
+    for each figure in it.  If rep is None, the current statistics are
+    formatted.
+    """
+    if rep is None:
+        rep = report()
+
+    def flatten(obj, prefix):
+        for key, val in sorted(obj.iteritems()):
+            if isinstance(val, dict):
+                for elt in flatten(val, prefix + key + '.'):
+                    yield elt
+            else:
+                yield prefix + key, val
+
+    lines = []
+    for key, val in flatten(rep, ''):
+        if isinstance(val, float):
+            val = '%.6g' % val
+        lines.append('%-40s %s' % (key, val))
+    return '\n'.join(lines)
+
+
+def _patches():
+    """[private] Return (owner, name, wrap) for each wrapper installed by
+    enable(); wrap(original) returns the replacement.
+    """
+    import classdata, classifier, mailwrangler, snapshot
+
+    grp = classdata.groupdata
+    res = [(grp, '_connect', _connect_wrapper),
+           (grp, '_write_words', _rows_wrapper('rows.words')),
+           (grp, '_write_groups', _rows_wrapper('rows.groups')),
+           (classdata.db_word, 'get_stored',
+            _op_wrapper('get_stored', track=False))]
+    for name, op in (('get_word', 'get_word'), ('_get_total', 'get_total'),
+                     ('prefetch', 'prefetch'), ('commit', 'commit'),
+                     ('compact', 'compact'), ('_load_groups', 'load_groups'),
+                     ('add_group', 'add_group'), ('read_setting', 'settings'),
+                     ('write_setting', 'settings'), ('add_setting',
+                                                     'settings')):
+        res.append((grp, name, _op_wrapper(op)))
+    for name in ('train', 'untrain', 'train_many', 'untrain_many'):
+        res.append((classifier.trainer, name, _op_wrapper(name)))
+    for cls in (classifier.classifier, snapshot.snapshot_classifier):
+        res.append((cls, 'classify', _op_wrapper('classify')))
+    for name in ('start', 'update', 'finish'):
+        res.append((classifier.hmm_model, name, _timer_wrapper('phase.' +
+                                                              name)))
+
+    res.extend(((mailwrangler, '_split_parts', _split_parts_wrapper),
+                (mailwrangler, '_decode_part', _decode_part_wrapper),
+                (mailwrangler, 'strip_html_chunks', _strip_wrapper)))
+    return res
+
+
+def _wraps(orig):
+    """[private] Copy the name and documentation of orig to a wrapper."""
+    def deco(func):
+        func.__name__ = orig.__name__
+        func.__doc__ = orig.__doc__
+        return func
+
+    return deco
+
+
+def _op_wrapper(op, track=True):
+    """[private] Wrap a method as a timed operation, to which the SQL
+    statements it issues are charged.  If track is true, the caches of
+    the objects it is called on are reported.
+    """
+    def wrap(orig):
+        @_wraps(orig)
+        def wrapper(self, *args, **kw):
+            if track:
+                _objects[self] = True
+            try:
+                ops = _local.ops
+            except AttributeError:
+                ops = _local.ops = []
+            ops.append(op)
+            start = time.time()
+            try:
+                return orig(self, *args, **kw)
+            finally:
+                current.add_time('op.' + op, time.time() - start)
+                ops.pop()
+
+        return wrapper
+
+    return wrap
+
+
+def _timer_wrapper(key):
+    """[private] Wrap a method to record its wall time under key."""
+    def wrap(orig):
+        @_wraps(orig)
+        def wrapper(self, *args, **kw):
+            _objects[self] = True
+            start = time.time()
+            try:
+                return orig(self, *args, **kw)
+            finally:
+                current.add_time(key, time.time() - start)
+
+        return wrapper
+
+    return wrap
+
+
+def _rows_wrapper(key):
+    """[private] Wrap a row writer to count the rows it is given."""
+    def wrap(orig):
+        @_wraps(orig)
+        def wrapper(self, cur, rows):
+            current.count(key, len(rows))
+            return orig(self, cur, rows)
+
+        return wrapper
+
+    return wrap
+
+
+def _connect_wrapper(orig):
+    @_wraps(orig)
+    def wrapper(self, *args, **kw):
+        _objects[self] = True
+        return _counting_connection(orig(self, *args, **kw))
+
+    return wrapper
+
+
+def _count_sql():
+    """[private] Charge one statement to the running operation."""
+    ops = getattr(_local, 'ops', None)
+    current.count('sql.' + (ops[-1] if ops else 'other'))
+
+
+class _counting_connection(object):
+    """[private] Wraps a database connection, counting the statements
+    issued through it and the cursors it returns.
+    """
+    def __init__(self, db):
+        self._db = db
+
+    def cursor(self):
+        return _counting_cursor(self._db.cursor())
+
+    def execute(self, *args):
+        _count_sql()
+        return self._db.execute(*args)
+
+    def executemany(self, *args):
+        _count_sql()
+        return self._db.executemany(*args)
+
+    def executescript(self, *args):
+        _count_sql()
+        return self._db.executescript(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+
+class _counting_cursor(object):
+    """[private] Wraps a database cursor, counting statements."""
+    def __init__(self, cur):
+        self._cur = cur
+
+    def execute(self, *args):
+        _count_sql()
+        self._cur.execute(*args)
+        return self
+
+    def executemany(self, *args):
+        _count_sql()
+        self._cur.executemany(*args)
+        return self
+
+    def executescript(self, *args):
+        _count_sql()
+        self._cur.executescript(*args)
+        return self
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self._cur.next()
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+
+def _timed_iter(key, seq):
+    """[private] Pass through the elements of seq, recording the wall
+    time spent producing them under key.
+    """
+    it, clock, spent = iter(seq), time.time, 0.0
+    try:
+        while True:
+            start = clock()
+            try:
+                elt = it.next()
+            except StopIteration:
+                spent += clock() - start
+                return
+            spent += clock() - start
+            yield elt
+    finally:
+        current.add_time(key, spent)
+
+
+def _split_parts_wrapper(orig):
+    # All the work of splitting the parts of a message is done while
+    # its words are read, so the parts and their words are timed.
+    @_wraps(orig)
+    def wrapper(parts, budget):
+        current.count('split.messages')
+        for part in _timed_iter('split.total', orig(parts, budget)):
+            current.count('split.parts')
+            yield _timed_iter('split.total', part)
+
+    return wrapper
+
+
+def _decode_part_wrapper(orig):
+    @_wraps(orig)
+    def wrapper(part, limit=None):
+        start = time.time()
+        text, size = orig(part, limit)
+        current.add_time('split.decode', time.time() - start)
+        current.count('split.bytes', size)
+        return text, size
+
+    return wrapper
+
+
+def _strip_wrapper(orig):
+    @_wraps(orig)
+    def wrapper(*args, **kw):
+        return _timed_iter('split.strip', orig(*args, **kw))
+
+    return wrapper
+
+
+__all__ = ('recorder', 'current', 'enable', 'disable', 'is_enabled', 'reset',
+           'timed', 'report', 'format_report')
+
+# Here there be dragons
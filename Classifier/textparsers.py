@@ -13,6 +13,10 @@ split_re = re.compile(
     r'[a-z0-9]+'
     r'(?:[-\'./][a-z0-9]+|'
     r'-\s*[a-z0-9]+)*)', re.IGNORECASE)
+ws_re = re.compile(r'\s+')
+
+# Matches text through the last whitespace that no word or entity spans
+segment_re = re.compile(r'.*[^-;\s]\s', re.DOTALL)
 
 
 def unfold_entities(text):
@@ -49,23 +53,37 @@ def word_split(text):
     In addition, URL's of the form "http://..." are considered a
     single word for the purposes of splitting.
     """
-    ws = re.compile(r'\s+')
-
-    pos = 0
-    while pos < len(text):
-        m = ws.match(text, pos)
-
-        if m:
-            pos += len(m.group())
+    # A word never begins with whitespace, so scanning for successive
+    # matches finds the same words as trying each position in turn.
+    # Whitespace can only occur in a word after a hyphen.
+    for m in split_re.finditer(text):
+        g = m.group()
+        if '-' in g:
+            g = ws_re.sub('', g)
+        yield g
+
+
+def text_segments(chunks):
+    """Regroup a sequence of text chunks into segments that may each be
+    given to unfold_entities() and word_split() separately, with the
+    same result as the text of all the chunks together.  A segment
+    ends at whitespace, unless the whitespace follows a hyphen (which
+    may join words) or a semicolon (which may end an entity).
+    """
+    hold = []
+    for chunk in chunks:
+        m = segment_re.match(chunk)
+        if m is None:
+            hold.append(chunk)
             continue
 
-        m = split_re.match(text, pos)
-        if m:
-            g = m.group()
-            pos += len(g)
-            yield ws.sub('', g)
-        else:
-            pos += 1
+        hold.append(chunk[:m.end()])
+        yield ''.join(hold)
+        hold = [chunk[m.end():]]
+
+    tail = ''.join(hold)
+    if tail:
+        yield tail
 
 
 def digrams(input):
@@ -171,6 +189,9 @@ def compose(*ts):
     transformations in the order given.  If no transformations are
     given, it is equivalent in effect to the identity transform.
     """
+    # The stages are not fused into one loop:  stepping each element
+    # through them costs a function call per stage, which was measured
+    # slower than resuming a generator per stage.
     def compose2(t1, t2):
         def composite(input):
             return t2(t1(input))
@@ -233,6 +254,7 @@ def dropwhile(pred, *args):
     first element for which the predicate gave false.
     """
     def dropper(input):
+        input = iter(input)
         for elt in input:
             if not pred(elt, *args):
                 yield elt
@@ -258,7 +280,9 @@ def limit_length(nchars):
 
 
 def lowercase(input):
-    return transform(lambda s: s.lower())(input)
+    """Convert each element of the input sequence to lower case."""
+    for elt in input:
+        yield elt.lower()
 
 
 class aggregator(object):
@@ -266,52 +290,112 @@ class aggregator(object):
     the format desired by the classification engine, which is a
     sequence of tuples of the form (word, count).  This object behaves
     like an iterable sequence type in most respects.
+
+    Counts are kept in a dictionary, so membership and .get() take
+    constant time.  The sequence is ordered by decreasing count, but
+    the order is only computed when it is needed; .iteritems() gives
+    the pairs in no particular order without computing it.
+    Aggregators may be merged with + and +=, or .update().
     """
-    def __init__(self, source, collapse=False):
+    def __init__(self, source=(), collapse=False):
         """Initialize the aggregator with a source of tokens."""
-        word_map = {}
+        self._counts = word_map = {}
+        self._data = None  # (word, count) pairs in order, if known
 
         for word in source:
             word_map[word] = word_map.get(word, 0) + 1
 
-        self._data = sorted(word_map.items(), key=lambda s: s[1], reverse=True)
         if collapse:
             self.collapse()
 
+    def _items(self):
+        """[private] Return the list of (word, count) pairs in order."""
+        if self._data is None:
+            self._data = sorted(self._counts.items(),
+                                key=lambda s: s[1],
+                                reverse=True)
+        return self._data
+
     def find(self, word):
         """Return the position of the given word in the collection, or
         else -1 to indicate the word is not present.
         """
-        for pos, (w, _) in enumerate(self):
+        if word not in self._counts:
+            return -1
+
+        for pos, (w, _) in enumerate(self._items()):
             if w == word:
                 return pos
 
-        return -1
+    def get(self, word, default=0):
+        """Return the count for word, or default if it is not present."""
+        return self._counts.get(word, default)
+
+    def iteritems(self):
+        """Iterate over the (word, count) pairs in no particular order."""
+        return self._counts.iteritems()
 
     def collapse(self):
         """Collapse all words to have a frequency of 1."""
-        self._data = list((w, 1) for w, c in self._data)
+        self._data = list((w, 1) for w, c in self._items())
+        self._counts = dict.fromkeys(self._counts, 1)
+
+    def update(self, other):
+        """Add the counts from other, which may be an aggregator or any
+        sequence of (word, count) pairs, into this collection.
+        """
+        if isinstance(other, aggregator):
+            other = other._counts.iteritems()
+
+        counts = self._counts
+        for word, count in other:
+            counts[word] = counts.get(word, 0) + count
+        self._data = None
+
+    def copy(self):
+        """Return a new aggregator with the same contents."""
+        new = aggregator()
+        new._counts = self._counts.copy()
+        new._data = self._data
+        return new
+
+    def __add__(self, other):
+        new = self.copy()
+        new.update(other)
+        return new
+
+    def __iadd__(self, other):
+        self.update(other)
+        return self
 
     def __len__(self):
         """Returns the number of distinct words in the collection."""
-        return len(self._data)
+        return len(self._counts)
 
     def __iter__(self):
         """Iterate over the (word, count) pairs in the collection."""
-        return iter(self._data)
+        return iter(self._items())
 
     def __contains__(self, word):
         """Returns True if word is in the collection, otherwise False."""
-        return self.find(word) >= 0
+        return word in self._counts
 
     def __getitem__(self, itm):
         """Index or slice into the collection."""
-        return self._data[itm]
+        return self._items()[itm]
+
+    def __getstate__(self):
+        # Pickle the ordered pairs, so the order survives the trip.
+        return self._items()
+
+    def __setstate__(self, state):
+        self._data = state
+        self._counts = dict(state)
 
 
-__all__ = ('unfold_entities', 'word_split', 'unique', 'select', 'transform',
-           'project', 'partition', 'segregate', 'compose', 'take', 'drop',
-           'takewhile', 'dropwhile', 'add_prefix', 'limit_length', 'lowercase',
-           'aggregator')
+__all__ = ('unfold_entities', 'word_split', 'text_segments', 'unique',
+           'select', 'transform', 'project', 'partition', 'segregate',
+           'compose', 'take', 'drop', 'takewhile', 'dropwhile', 'add_prefix',
+           'limit_length', 'lowercase', 'aggregator')
 
 # Here there be dragons
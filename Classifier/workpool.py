@@ -0,0 +1,321 @@
+##
+## Name:     workpool.py
+## Purpose:  Classify and train concurrently with a pool of threads.
+##
+## Copyright (C) 2008 Michael J. Fromberger, All Rights Reserved.
+##
+## A classifier_pool lets a program that must not block, such as a mail
+## gateway driven by an event loop, hand documents off to be classified
+## and get the results back later.  Each request returns at once with a
+## "pending" result, which can be waited for, or given a callback to be
+## run when the result is ready.  Callbacks run in a worker thread; an
+## event loop should use them only to pass the result to its own thread
+## (e.g., by writing to a pipe it watches).
+##
+## Each worker thread has its own read-only connection to the database.
+## A worker takes all the requests waiting in the queue, up to a batch,
+## and classifies them together (see hmm_model.classify_many()), so the
+## words they share are looked up and scored only once.  The queue has
+## a fixed size; when it is full, new requests wait for room, or fail if
+## they are not allowed to wait, so that a burst of requests slows its
+## sender down instead of growing the queue without limit.
+##
+## If the pool is created with trainable=True, one more thread, with a
+## writable connection, carries out training requests, and commits all
+## those waiting in its queue together.  The workers see the changes
+## once they are committed.  A request that fails changes nothing; the
+## others committed with it are unaffected.
+##
+
+import Queue, sys, threading, traceback
+from classifier import hmm_classifier, merge_counts
+
+# Number of requests a worker takes from the queue together
+default_batch_size = 64
+
+# Number of requests that may wait in a queue before senders must wait
+default_max_pending = 1024
+
+
+class pending(object):
+    """The result of a request to a classifier_pool, which may not yet
+    be available.
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._value = None
+        self._error = None
+
+    def done(self):
+        """Return True if the result is available."""
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """Wait until the result is available, or until timeout seconds
+        have passed.  Returns True if the result is available.
+        """
+        return self._event.wait(timeout)
+
+    def result(self):
+        """Wait for the result and return it.  If the request failed,
+        the exception it raised is raised again here.
+        """
+        self._event.wait()
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._value
+
+    def add_callback(self, func):
+        """Arrange for func to be called with this object when the result
+        is available, in the thread that produced it.  If the result is
+        already available, func is called at once.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(func)
+                return
+        self._call(func)
+
+    def _finish(self, value=None, error=None):
+        """[private] Record the result, or the exception info error, and
+        run the callbacks.
+        """
+        with self._lock:
+            self._value = value
+            self._error = error
+            self._event.set()
+            funcs, self._callbacks = self._callbacks, []
+        for func in funcs:
+            self._call(func)
+
+    def _call(self, func):
+        """[private] Call func with self, reporting any exception it
+        raises, which would otherwise stop the worker thread.
+        """
+        try:
+            func(self)
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+
+
+class classifier_pool(object):
+    """A pool of threads that classify documents with hmm_classifier
+    instances reading from the same database; see the module comments.
+    """
+    def __init__(self,
+                 db_path,
+                 workers=2,
+                 max_pending=default_max_pending,
+                 batch_size=default_batch_size,
+                 trainable=False,
+                 **options):
+        """Initializes a new pool and starts its threads.
+
+        db_path     -- where the database file is located.
+        workers     -- number of threads that classify.
+        max_pending -- number of requests that may wait in each queue.
+        batch_size  -- largest number of requests handled together.
+        trainable   -- if true, start a thread to carry out training.
+
+        Other keyword options are passed to hmm_classifier.  Raises the
+        exception raised by any thread in opening the database.
+
+        Scoring holds the interpreter lock, so more workers help only
+        when lookups wait on the disk; one or two are usually enough.
+        """
+        if workers < 1:
+            raise ValueError("A pool requires at least one worker")
+        options.pop('read_only', None)
+
+        self._batch_size = batch_size
+        self._path = db_path
+        self._queue = Queue.Queue(max_pending)
+        self._train_queue = None
+        self._threads = []
+
+        try:
+            # The writer starts first, since it may create the database.
+            if trainable:
+                self._train_queue = Queue.Queue(max_pending)
+                self._start(self._train_loop, self._train_queue, options)
+            for _ in xrange(workers):
+                self._start(self._classify_loop, self._queue,
+                            dict(options, read_only=True))
+        except:
+            self.close()
+            raise
+
+    def classify(self, doc, block=True, timeout=None):
+        """Request the classification of doc, a sequence of (word, count)
+        pairs such as a textparsers.aggregator.  Returns a pending whose
+        result is a dictionary of group scores, as for hmm_model.finish();
+        use classifier.argmax() to choose the group.
+
+        If the queue is full, waits for room, for at most timeout seconds
+        if it is not None; if block is false or the time runs out, raises
+        Queue.Full.
+        """
+        res = pending()
+        self._queue.put((doc, res), block, timeout)
+        return res
+
+    def train(self, doc, groups, block=True, timeout=None):
+        """Request that doc, as for .classify(), be trained as a member
+        of the given groups.  Returns a pending whose result is None once
+        the change has been committed.  The queue is as for .classify().
+        Raises TypeError if the pool was not created with trainable=True.
+        """
+        if self._train_queue is None:
+            raise TypeError("This pool does not permit training")
+
+        res = pending()
+        self._train_queue.put((doc, tuple(groups), res), block, timeout)
+        return res
+
+    def pending_requests(self):
+        """Return the approximate number of requests waiting for a
+        thread.
+        """
+        num = self._queue.qsize()
+        if self._train_queue is not None:
+            num += self._train_queue.qsize()
+        return num
+
+    def close(self):
+        """Finish the requests already made, then stop the threads and
+        close their database connections.
+        """
+        threads, self._threads = self._threads, []
+        for thread, queue in threads:
+            queue.put(None)
+        for thread, queue in threads:
+            thread.join()
+
+    def _start(self, loop, queue, options):
+        """[private] Start a thread running loop, with a classifier opened
+        with options, to take requests from queue.  Waits for it to open
+        the database, and raises any exception it raised in doing so.
+        """
+        ready = pending()
+        thread = threading.Thread(target=loop, args=(options, ready))
+        thread.daemon = True
+        thread.start()
+        ready.result()
+        self._threads.append((thread, queue))
+
+    def _open(self, options, ready):
+        """[private] Open a classifier in the calling thread, and report
+        the outcome to ready.  Returns None if the database could not
+        be opened.
+        """
+        try:
+            cls = hmm_classifier(self._path, **options)
+        except Exception:
+            ready._finish(error=sys.exc_info())
+            return None
+
+        ready._finish()
+        return cls
+
+    def _take(self, queue):
+        """[private] Wait for a request in queue, then take as many more
+        as are waiting, up to a batch.  Returns a list of requests, and a
+        flag that is true if the pool is closing.
+        """
+        batch = []
+        elt = queue.get()
+        while elt is not None:
+            batch.append(elt)
+            if len(batch) >= self._batch_size:
+                return batch, False
+            try:
+                elt = queue.get_nowait()
+            except Queue.Empty:
+                return batch, False
+
+        return batch, True
+
+    def _classify_loop(self, options, ready):
+        """[private] Body of a worker thread that classifies."""
+        cls = self._open(options, ready)
+        if cls is None:
+            return
+
+        try:
+            closing = False
+            while not closing:
+                batch, closing = self._take(self._queue)
+                if not batch:
+                    continue
+
+                try:
+                    cls.refresh()
+                    results = list(
+                        cls.classify_many((doc for doc, res in batch),
+                                          len(batch)))
+                except Exception:
+                    error = sys.exc_info()
+                    for doc, res in batch:
+                        res._finish(error=error)
+                else:
+                    for (doc, res), value in zip(batch, results):
+                        res._finish(value)
+        finally:
+            cls.close()
+
+    def _train_loop(self, options, ready):
+        """[private] Body of the thread that trains."""
+        cls = self._open(options, ready)
+        if cls is None:
+            return
+
+        try:
+            closing = False
+            while not closing:
+                batch, closing = self._take(self._train_queue)
+                if not batch:
+                    continue
+
+                # Requests that fail are reported alone; the rest are
+                # committed together when the session ends.  Each
+                # document is first summed into counts of its own, so
+                # one that fails to read changes nothing.  If training
+                # still fails partway, the changes of the session are
+                # discarded, and the requests trained before it are
+                # trained again from their counts.
+                done = []
+                try:
+                    with cls.session(max_docs=None):
+                        for doc, groups, res in batch:
+                            try:
+                                delta, num = merge_counts([doc])
+                            except Exception:
+                                res._finish(error=sys.exc_info())
+                                continue
+
+                            try:
+                                cls.train(delta, groups)
+                            except Exception:
+                                res._finish(error=sys.exc_info())
+                                cls.discard()
+                                for elt in done:
+                                    cls.train(*elt[:2])
+                            else:
+                                done.append((delta, groups, res))
+                except Exception:
+                    error = sys.exc_info()
+                    cls.discard()
+                    for delta, groups, res in done:
+                        res._finish(error=error)
+                else:
+                    for delta, groups, res in done:
+                        res._finish()
+        finally:
+            cls.close()
+
+
+__all__ = ('classifier_pool', 'pending')
+
+# Here there be dragons
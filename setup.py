@@ -32,6 +32,9 @@ This code requires Python 2.5 or newer, and the sqlite3 module.""",
       ],
       packages=['Classifier'],
       package_dir={'Classifier': 'Classifier'},
-      scripts=['mailtagger', 'mailtrainer', 'maildumper'])
+      scripts=[
+          'mailtagger', 'mailtrainer', 'maildumper', 'mailsnapshot',
+          'mailtagd', 'mailtagc', 'mailcompact', 'mailreplay'
+      ])
 
 # Here there be dragons
@@ -0,0 +1,153 @@
+##
+## Name:     test_changelog.py
+## Purpose:  Tests for Classifier.changelog.
+##
+## Copyright (C) 2008 Michael J. Fromberger, All Rights Reserved.
+##
+
+import json, os, shutil, tempfile, unittest
+import sqlite3.dbapi2 as sql
+from cStringIO import StringIO
+from Classifier import changelog
+from Classifier.changelog import read_log, replay_log, trim_log
+from Classifier.classdata import groupdata
+from test_classdata import fail_once
+
+
+class log_test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='test_changelog')
+        self.path = os.path.join(self.dir, 'data.db')
+        self.log = os.path.join(self.dir, 'changes.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def train(self, counts):
+        data = groupdata(self.path, change_log=self.log)
+        try:
+            grp = data.add_group('g')
+            for text, count in counts:
+                wrd = grp.get_word(text)
+                wrd += count
+            data.commit()
+        finally:
+            data.close()
+
+    def sequences(self):
+        with open(self.log, 'rb') as fp:
+            return list(seq for seq, rec in read_log(fp))
+
+    def counts(self, path):
+        data = groupdata(path, read_only=True)
+        try:
+            grp = data.get_group('g')
+            return data.log_sequence(), dict(
+                (t, grp.get_word(t).get_count())
+                for t in ('alpha', 'beta', 'gamma'))
+        finally:
+            data.close()
+
+    def replayed(self):
+        path = os.path.join(self.dir, 'copy.db')
+        data = groupdata(path)
+        try:
+            with open(self.log, 'rb') as fp:
+                replay_log(fp, data)
+        finally:
+            data.close()
+        return self.counts(path)
+
+    def test_crash_before_commit(self):
+        self.train([('alpha', 1)])
+
+        # A crash after logging the second commit, but before it reached
+        # the database, leaves a line the database does not include.
+        shutil.copy(self.path, self.path + '.old')
+        self.train([('beta', 5)])
+        shutil.copy(self.path + '.old', self.path)
+        with open(self.log, 'ab') as fp:
+            fp.write('[3,{"hash"')
+        self.assertEqual(self.sequences(), [1, 2, 3])
+
+        self.train([('gamma', 2)])
+        self.assertEqual(self.sequences(), [1, 2, 3])
+        self.assertEqual(self.replayed(), self.counts(self.path))
+        self.assertEqual(self.counts(self.path)[1],
+                         dict(alpha=1, beta=0, gamma=2))
+
+    def test_commit_fails(self):
+        self.train([('alpha', 1)])
+        size = os.path.getsize(self.log)
+
+        data = groupdata(self.path, change_log=self.log)
+        try:
+            wrd = data.get_group('g').get_word('beta')
+            wrd += 5
+            fail_once(data)
+            self.assertRaises(sql.OperationalError, data.commit)
+            self.assertEqual(os.path.getsize(self.log), size)
+            data.commit()
+
+            fail_once(data)
+            self.assertRaises(sql.OperationalError, data.add_group, 'h')
+            self.assertFalse(data.has_group('h'))
+            data.add_group('h')
+        finally:
+            data.close()
+
+        self.train([('gamma', 2)])
+        self.assertEqual(self.sequences(), [1, 2, 3, 4, 5])
+        self.assertEqual(self.replayed(), self.counts(self.path))
+        self.assertEqual(self.counts(self.path)[1],
+                         dict(alpha=1, beta=5, gamma=2))
+
+    def test_missing_records(self):
+        self.train([('alpha', 1)])
+        self.train([('beta', 5)])
+        self.train([('gamma', 2)])
+        with open(self.log, 'rb') as fp:
+            lines = fp.readlines()
+        with open(self.log, 'wb') as fp:
+            fp.writelines(lines[:1] + lines[2:])
+
+        try:
+            self.replayed()
+        except ValueError, e:
+            self.assertTrue('missing records 2 to 2' in str(e), str(e))
+        else:
+            self.fail('replay did not report the missing record')
+
+
+class trim_test(unittest.TestCase):
+    def trimmed(self, text, last):
+        fp = StringIO()
+        fp.write(text)
+        num = trim_log(fp, last)
+        return num, fp.getvalue()
+
+    def test_trim(self):
+        lines = ''.join(
+            json.dumps([seq, dict(hash=None, pad='x' * 100 * seq)]) + '\n'
+            for seq in xrange(1, 6))
+        keep = lines[:lines.index('[4,')]
+        self.assertEqual(self.trimmed(lines, 5), (0, lines))
+        self.assertEqual(self.trimmed(lines, 3), (2, keep))
+        self.assertEqual(self.trimmed(lines + '[6,{', 3), (3, keep))
+        self.assertEqual(self.trimmed(lines, 0), (5, ''))
+        self.assertEqual(self.trimmed('', 0), (0, ''))
+
+    def test_lines_backward(self):
+        text = 'a\nbb\n\nccc\nd'
+        for size in (1, 2, 3, 100):
+            self.assertEqual(
+                list(changelog._lines_backward(StringIO(text), len(text),
+                                               size)),
+                [(10, 'd'), (6, 'ccc\n'), (5, '\n'), (2, 'bb\n'),
+                 (0, 'a\n')])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# Here there be dragons
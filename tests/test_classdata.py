@@ -0,0 +1,129 @@
+##
+## Name:     test_classdata.py
+## Purpose:  Tests for Classifier.classdata.
+##
+## Copyright (C) 2008 Michael J. Fromberger, All Rights Reserved.
+##
+
+import os, shutil, tempfile, unittest
+import sqlite3.dbapi2 as sql
+from Classifier.classdata import groupdata
+
+
+def fail_once(data):
+    """Make the next commit of the transaction of data fail, as when
+    the database is locked.
+    """
+    commit = data._commit
+
+    def fail():
+        data._commit = commit
+        raise sql.OperationalError('database is locked')
+
+    data._commit = fail
+
+
+class commit_test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='test_classdata')
+        self.path = os.path.join(self.dir, 'data.db')
+        data = groupdata(self.path)
+        data.add_group('g')
+        grp = data.get_group('g')
+        for text, count in (('alpha', 3), ('beta', 1)):
+            wrd = grp.get_word(text)
+            wrd += count
+        data.commit()
+        data.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def counts(self):
+        data = groupdata(self.path, read_only=True)
+        try:
+            grp = data.get_group('g')
+            return dict((t, grp.get_word(t).get_count())
+                        for t in ('alpha', 'beta'))
+        finally:
+            data.close()
+
+    def test_loaded_counts(self):
+        data = groupdata(self.path)
+        grp = data.get_group('g')
+        for text in ('alpha', 'beta'):
+            wrd = grp.get_word(text)
+            wrd.get_count()
+            wrd += 2
+        data.commit()
+        data.close()
+        self.assertEqual(self.counts(), {'alpha': 5, 'beta': 3})
+
+    def test_row_removed_by_other_writer(self):
+        data = groupdata(self.path)
+        grp = data.get_group('g')
+        wrd = grp.get_word('beta')
+        self.assertEqual(wrd.get_count(), 1)
+
+        other = groupdata(self.path)
+        owrd = other.get_group('g').get_word('beta')
+        owrd -= 1
+        other.commit()
+        other.close()
+
+        wrd += 2
+        data.commit()
+        data.close()
+        self.assertEqual(self.counts(), {'alpha': 3, 'beta': 2})
+
+
+class retry_test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='test_classdata')
+        self.path = os.path.join(self.dir, 'data.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check_retry(self, shards):
+        data = groupdata(self.path, shards=shards)
+        try:
+            grp = data.add_group('g')
+            wrd = grp.get_word('alpha')
+            wrd += 1
+            data.commit()
+
+            # An increment to a stored word, and a new word.
+            for text in ('alpha', 'beta'):
+                wrd = grp.get_word(text)
+                wrd += 1
+            grp += 1
+            data.tick(1)
+            fail_once(data)
+            self.assertRaises(sql.OperationalError, data.commit)
+            data.commit()
+        finally:
+            data.close()
+
+        data = groupdata(self.path, read_only=True)
+        try:
+            grp = data.get_group('g')
+            self.assertEqual(
+                dict((t, (grp.get_word(t).get_count(), data.get_total(t)))
+                     for t in ('alpha', 'beta')),
+                {'alpha': (2, 2), 'beta': (1, 1)})
+            self.assertEqual((grp.count, data.clock()), (1, 1))
+        finally:
+            data.close()
+
+    def test_retry(self):
+        self.check_retry(None)
+
+    def test_retry_sharded(self):
+        self.check_retry(2)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# Here there be dragons
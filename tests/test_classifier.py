@@ -0,0 +1,105 @@
+##
+## Name:     test_classifier.py
+## Purpose:  Tests for Classifier.classifier.
+##
+## Copyright (C) 2008 Michael J. Fromberger, All Rights Reserved.
+##
+
+import os, shutil, tempfile, unittest
+from Classifier import aggregator, hmm_classifier, word_split
+
+training = (
+    ('spam', 'cheap pills buy now limited offer act now'),
+    ('spam', 'buy cheap watches now best offer'),
+    ('ham', 'lunch at noon today with the team'),
+    ('ham', 'meeting notes from the team lunch'),
+)
+
+
+def doc(text):
+    return aggregator(word_split(text))
+
+
+class feature_cache_test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='test_classifier')
+        self.path = os.path.join(self.dir, 'data.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def trained(self, **options):
+        cls = hmm_classifier(self.path, **options)
+        cls.add_group('spam')
+        cls.add_group('ham')
+        for group, text in training:
+            cls.train(doc(text), [group])
+        return cls
+
+    def fresh_result(self, input):
+        cls = hmm_classifier(self.path, read_only=True)
+        try:
+            cls.classify(input)
+            return cls.result()
+        finally:
+            cls.close()
+
+    def check_commit(self, **options):
+        cls = self.trained(**options)
+        try:
+            probe = doc('cheap lunch offer for the team now')
+            cls.classify(probe)
+            cached = len(cls._features)
+
+            # Only the records of the words trained are discarded.
+            cls.train(doc('cheap offer'), ['ham'])
+            self.assertEqual(len(cls._features), cached - 2)
+
+            cls.classify(probe)
+            self.assertEqual(cls.result(), self.fresh_result(probe))
+        finally:
+            cls.close()
+
+    def test_commit_text(self):
+        self.check_commit()
+
+    def test_commit_hashed(self):
+        self.check_commit(word_hash=0)
+
+    def test_new_group(self):
+        cls = self.trained()
+        try:
+            probe = doc('cheap lunch offer for the team now')
+            cls.classify(probe)
+            cls.add_group('other')
+            cls.classify(probe)
+            self.assertEqual(cls.result(), self.fresh_result(probe))
+        finally:
+            cls.close()
+
+    def test_cached_words_not_fetched(self):
+        cls = self.trained()
+        try:
+            probe = doc('cheap lunch offer for the team now')
+            cls.classify(probe)
+
+            # Words whose features are cached are not looked up again.
+            fetched = []
+            prefetch = cls.prefetch
+
+            def spy(words, *args, **options):
+                words = list(words)
+                fetched.extend(words)
+                return prefetch(words, *args, **options)
+
+            cls.prefetch = spy
+            cls.classify(probe)
+            self.assertEqual(fetched, [])
+        finally:
+            cls.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# Here there be dragons
@@ -0,0 +1,76 @@
+##
+## Name:     test_mailserver.py
+## Purpose:  Tests for Classifier.mailserver.
+##
+## Copyright (C) 2008 Michael J. Fromberger, All Rights Reserved.
+##
+
+import os, shutil, socket, tempfile, threading, unittest
+from Classifier import aggregator, hmm_classifier, tag_server, word_split
+
+good_message = 'Subject: lunch\n\nlunch at noon today\n'
+
+# The unknown charset makes split_mail() fail.
+bad_message = ('Subject: hello\n'
+               'Content-Type: text/plain; charset=x-no-such-charset\n'
+               '\n'
+               'hello \xff\xfe\n')
+
+
+class server_test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='test_mailserver')
+        cls = hmm_classifier(os.path.join(self.dir, 'data.db'),
+                             check_same_thread=False)
+        cls.add_group('spam')
+        cls.add_group('ham')
+        cls.train(aggregator(word_split('cheap pills buy now')), ['spam'])
+        cls.train(aggregator(word_split('lunch at noon today')), ['ham'])
+
+        self.path = os.path.join(self.dir, 'server.sock')
+        self.server = tag_server(self.path, cls)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        self.server.classifier.close()
+        shutil.rmtree(self.dir)
+
+    def request(self, cmd, data):
+        """Send one request, and return the first line of the reply and
+        whatever follows it.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+            sock.sendall('%s %d\n%s' % (cmd, len(data), data))
+            sock.shutdown(socket.SHUT_WR)
+            fp = sock.makefile('rb')
+            line = fp.readline()
+            return line, fp.read()
+        finally:
+            sock.close()
+
+    def test_tag(self):
+        line, rest = self.request('TAG', good_message)
+        self.assertEqual(line, 'OK 3\n')
+        self.assertEqual(rest[:3], 'ham')
+
+    def test_malformed_message(self):
+        for cmd in ('TAG', 'FILTER'):
+            line, rest = self.request(cmd, bad_message)
+            self.assertTrue(line.startswith('ERR '), line)
+            self.assertEqual(rest, '')
+
+        # The server is still serving.
+        line, rest = self.request('TAG', good_message)
+        self.assertEqual(line, 'OK 3\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# Here there be dragons
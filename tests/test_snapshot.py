@@ -0,0 +1,60 @@
+##
+## Name:     test_snapshot.py
+## Purpose:  Tests for Classifier.snapshot.
+##
+## Copyright (C) 2008 Michael J. Fromberger, All Rights Reserved.
+##
+
+import os, shutil, tempfile, unittest
+import sqlite3.dbapi2 as sql
+from Classifier import hmm_classifier, model_snapshot, word_split, aggregator
+
+
+class load_test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='test_snapshot')
+        db_path = os.path.join(self.dir, 'data.db')
+        cls = hmm_classifier(db_path)
+        cls.add_group('spam')
+        cls.add_group('ham')
+        cls.train(aggregator(word_split('cheap pills buy now')), ['spam'])
+        cls.train(aggregator(word_split('lunch at noon today')), ['ham'])
+        cls.close()
+
+        self.path = os.path.join(self.dir, 'data.snap')
+        model_snapshot.from_database(db_path).save(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        snap = model_snapshot.load(self.path)
+        self.assertEqual(sorted(snap.names), ['ham', 'spam'])
+        self.assertEqual(snap.doc_count, 2)
+
+    def test_truncated(self):
+        with open(self.path, 'rb') as fp:
+            data = fp.read()
+
+        bad_path = os.path.join(self.dir, 'bad.snap')
+        for size in xrange(0, len(data), max(1, len(data) // 200)):
+            with open(bad_path, 'wb') as fp:
+                fp.write(data[:size])
+            self.assertRaises(TypeError, model_snapshot.load, bad_path)
+
+    def test_not_a_snapshot(self):
+        bad_path = os.path.join(self.dir, 'bad.snap')
+        with open(bad_path, 'wb') as fp:
+            fp.write('From nobody\nSubject: not a snapshot\n\n')
+        self.assertRaises(TypeError, model_snapshot.load, bad_path)
+
+    def test_missing_database(self):
+        db_path = os.path.join(self.dir, 'nosuch.db')
+        self.assertRaises(sql.Error, model_snapshot.from_database, db_path)
+        self.assertFalse(os.path.exists(db_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# Here there be dragons
@@ -0,0 +1,73 @@
+##
+## Name:     test_stats.py
+## Purpose:  Tests for Classifier.stats.
+##
+## Copyright (C) 2008 Michael J. Fromberger, All Rights Reserved.
+##
+
+import os, shutil, sys, tempfile, threading, unittest
+from Classifier import stats
+from Classifier.classdata import groupdata
+
+
+class recorder_test(unittest.TestCase):
+    def setUp(self):
+        # Switch threads as often as possible, to expose lost updates.
+        self.interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+
+    def tearDown(self):
+        sys.setcheckinterval(self.interval)
+
+    def test_threads(self):
+        rec = stats.recorder()
+        nthreads, ncalls = 8, 5000
+
+        def work():
+            for _ in xrange(ncalls):
+                rec.count('n')
+                rec.add_time('t', 1.0)
+
+        threads = list(threading.Thread(target=work)
+                       for _ in xrange(nthreads))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(rec.get_count('n'), nthreads * ncalls)
+        self.assertEqual(rec.get_timer('t'),
+                         (nthreads * ncalls, float(nthreads * ncalls)))
+
+
+class sharded_test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='test_stats')
+        stats.reset()
+        stats.enable()
+
+    def tearDown(self):
+        stats.disable()
+        stats.reset()
+        shutil.rmtree(self.dir)
+
+    def test_rows_written(self):
+        data = groupdata(os.path.join(self.dir, 'data.db'), shards=4)
+        try:
+            data.add_group('g')
+            grp = data.get_group('g')
+            for i in xrange(2000):
+                wrd = grp.get_word('w%d' % i)
+                wrd += 1
+            data.commit()
+        finally:
+            data.close()
+
+        rep = stats.report()
+        self.assertEqual(rep['commit']['word_rows'], 2000)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# Here there be dragons
@@ -0,0 +1,65 @@
+##
+## Name:     test_textparsers.py
+## Purpose:  Tests for Classifier.textparsers.
+##
+## Copyright (C) 2008 Michael J. Fromberger, All Rights Reserved.
+##
+
+import imp, os, random, unittest
+from Classifier.textparsers import word_split
+
+
+def load_bench(name):
+    """Load the script bench/name as a module."""
+    return imp.load_source(
+        name,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                     'bench', name))
+
+
+# The generator of the benchmark corpus supplies realistic mail text,
+# and the benchmark the implementation word_split() is measured against.
+mkcorpus = load_bench('mkcorpus')
+reference_word_split = load_bench('runbench').reference_word_split
+
+edge_cases = (
+    u'', u' ', u'-', u'--', u'a', u'a-', u'-a', u'a- b', u'a -b',
+    u'a-\n\t b', u'a- -b', u"it's", u"'quoted'", u'a.b.c.', u'..a..',
+    u'x/y/z', u'$10.50', u'#3', u'$', u'50%', u'%50', u'http://x.y/z?q',
+    u'<http://x.y/>', u'https://', u'caf\xe9 na\xefve', u'\u20ac100',
+    u'e-\n mail', u'1-2-3', u'a--b', u"a'-b", u'A.B-c d', u'\x00a\x00b',
+)
+
+
+class word_split_test(unittest.TestCase):
+    def check(self, text):
+        self.assertEqual(list(word_split(text)),
+                         list(reference_word_split(text)), repr(text))
+
+    def test_edge_cases(self):
+        for text in edge_cases:
+            self.check(text)
+
+    def test_mail_corpus(self):
+        maker = mkcorpus.corpus_maker(1)
+        for num in xrange(100):
+            group, msg = maker.message(num)
+            self.check(msg.as_string())
+            for part in msg.walk():
+                if part.get_content_maintype() == 'text':
+                    data = part.get_payload(decode=True)
+                    self.check(data)
+                    self.check(data.decode('utf-8', 'replace'))
+
+    def test_random_text(self):
+        rng = random.Random(1)
+        alphabet = u'abcXYZ019 \t\n-\'./:?#$%&<>\xe9'
+        for _ in xrange(2000):
+            self.check(u''.join(rng.choice(alphabet)
+                                for _ in xrange(rng.randint(0, 60))))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# Here there be dragons
@@ -0,0 +1,93 @@
+##
+## Name:     test_workpool.py
+## Purpose:  Tests for Classifier.workpool.
+##
+## Copyright (C) 2008 Michael J. Fromberger, All Rights Reserved.
+##
+
+import os, shutil, tempfile, threading, unittest
+from Classifier import aggregator, classifier_pool, hmm_classifier
+
+
+class poison(object):
+    """A count that survives being summed, but fails to be trained once
+    it has been trained ok times.
+    """
+    def __init__(self, ok):
+        self.ok = ok
+
+    def __radd__(self, other):
+        return self
+
+    def __rmul__(self, other):
+        if self.ok <= 0:
+            raise TypeError("poisoned count")
+        self.ok -= 1
+        return other
+
+
+def held(event):
+    """Generate a document once event is set."""
+    event.wait()
+    yield 'gate', 1
+
+
+def unreadable():
+    """Generate part of a document, then fail."""
+    yield 'unread', 1
+    raise IOError("message truncated")
+
+
+class train_test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='test_workpool')
+        self.path = os.path.join(self.dir, 'data.db')
+        cls = hmm_classifier(self.path)
+        cls.add_group('spam')
+        cls.add_group('ham')
+        cls.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_failed_requests(self):
+        pool = classifier_pool(self.path, workers=1, trainable=True)
+        try:
+            # Hold the trainer, so the rest arrive as one batch.
+            gate = threading.Event()
+            first = pool.train(held(gate), ['ham'])
+            good = pool.train(aggregator(['lunch', 'noon']), ['ham'])
+            unread = pool.train(unreadable(), ['spam'])
+            count = poison(2)
+            bad = pool.train(list((w, count)
+                                  for w in ('pills', 'cheap', 'offer')),
+                             ['spam'])
+            nogroup = pool.train(aggregator(['pills']), ['nosuch'])
+            last = pool.train(aggregator(['team', 'lunch']), ['ham'])
+            gate.set()
+
+            for res in (first, good, last):
+                self.assertEqual(res.result(), None)
+            self.assertRaises(IOError, unread.result)
+            self.assertRaises(TypeError, bad.result)
+            self.assertRaises(KeyError, nogroup.result)
+        finally:
+            pool.close()
+
+        cls = hmm_classifier(self.path, read_only=True)
+        try:
+            spam, ham = cls.get_group('spam'), cls.get_group('ham')
+            for word in ('pills', 'cheap', 'offer', 'unread'):
+                self.assertEqual(spam.get_word(word).get_count(), 0, word)
+            self.assertEqual(ham.get_word('lunch').get_count(), 2)
+            self.assertEqual(ham.get_word('gate').get_count(), 1)
+            self.assertEqual((spam.count, ham.count), (0, 3))
+            self.assertEqual(cls.get_doc_count(), 3)
+        finally:
+            cls.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# Here there be dragons